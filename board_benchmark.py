@@ -0,0 +1,271 @@
+"""
+board_benchmark times the board_solver engines on samples of the shipped board
+files, so runs before and after a change can be compared.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from typing import List
+
+import board_corpus
+import board_solver as bs
+
+try:
+    import resource
+except ImportError:
+    # benchmark reports no peak memory without it (e.g. on Windows)
+    resource = None
+
+# The board files benchmark samples from, relative to this file
+BENCHMARK_CORPORA = (
+    "easy_medium_hard.txt",
+    "usable_boards_solvable.txt",
+    os.path.join("board_comp_files", "usable_boards_diffcmp.txt"),
+)
+# How many boards benchmark samples from each corpus, and the seed it samples with
+BENCHMARK_SAMPLE = 3
+BENCHMARK_SEED = 2020
+# Wall seconds benchmark gives each solve
+BENCHMARK_TIME = 20
+# How much worse than the baseline a benchmark figure can get before it is flagged
+BENCHMARK_THRESHOLD = 0.25
+BENCHMARK_BASELINE = "benchmark_baseline.json"
+
+########################################################################################
+
+def load_boards(path: str) -> List[bs.PegSolitaire]:
+    """ The boards of a BoardCorpus, or of a file of frozensets (as
+        board_solver.process_frozen_sets reads) or of JSON grids, one per line (as
+        peg_solitaire_game reads)
+    """
+    with open(path, "rb") as f:
+        if f.read(len(board_corpus.CORPUS_MAGIC)) == board_corpus.CORPUS_MAGIC:
+            corpus = board_corpus.BoardCorpus(path)
+            boards = list(corpus)
+            corpus.close()
+            return boards
+    with open(path) as f:
+        first = f.readline()
+    if first.startswith("["):
+        with open(path) as f:
+            return [
+                bs.PegSolitaire(None, json.loads(line)) for line in f if line.strip()
+            ]
+    return [bs.PegSolitaire(fz) for fz in bs.iter_frozen_sets(path)]
+
+
+def _benchmark_task(engine: str, boards: list, budget: bs.Budget) -> dict:
+    """ Solves boards with engine in a fresh worker process, so the peak memory
+        it reports is this engine's alone
+    """
+    figures = {
+        "boards": len(boards), "solved": 0, "stopped": 0, "nodes": 0, "seconds": 0.0,
+    }
+    first_solutions = []
+    for board in boards:
+        start = time.perf_counter()
+        solved = bs.ENGINES[engine](board, budget=budget)
+        seconds = time.perf_counter() - start
+        figures["nodes"] += budget.nodes
+        figures["seconds"] += seconds
+        if solved:
+            figures["solved"] += 1
+            first_solutions.append(seconds)
+        elif budget.stopped is not None:
+            figures["stopped"] += 1
+
+    figures["nodes_per_second"] = figures["nodes"] / max(figures["seconds"], 1e-9)
+    figures["first_solution"] = (
+        sum(first_solutions) / len(first_solutions) if first_solutions else None
+    )
+    # ru_maxrss is in KiB on Linux but in bytes on macOS
+    figures["peak_memory"] = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        figures["peak_memory"] = peak if sys.platform == "darwin" else peak * 1024
+    return figures
+
+
+def benchmark(engines: list = None, sample: int = BENCHMARK_SAMPLE,
+              seed: int = BENCHMARK_SEED, budget: bs.Budget = None) -> dict:
+    """ Times the solver engines on a fixed sample of boards from each of the
+        BENCHMARK_CORPORA, so runs before and after a change can be compared.
+        The same seed always picks the same boards, and every solve runs under
+        budget (BENCHMARK_TIME seconds if not given), the nodes limit of which
+        makes the work done repeatable across machines.
+
+        Returns a dict of the settings it ran with and, under "results", a dict
+        per corpus of a dict per engine of:
+            boards, solved, stopped: boards solved, and boards whose search
+                went over budget
+            nodes, seconds: totals over the boards
+            nodes_per_second: nodes / seconds
+            first_solution: mean seconds to find a solution, over boards solved
+            peak_memory: peak resident bytes of the process running the engine
+    """
+    engines = sorted(bs.ENGINES) if engines is None else engines
+    budget = bs.Budget(seconds=BENCHMARK_TIME) if budget is None else budget
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    results = {}
+    for corpus in BENCHMARK_CORPORA:
+        boards = load_boards(os.path.join(here, corpus))
+        picked = random.Random(seed).sample(
+            range(len(boards)), min(sample, len(boards))
+        )
+        boards = [boards[i] for i in sorted(picked)]
+        results[corpus] = {}
+        for engine in engines:
+            initargs = (
+                bs.BOARD_SOLVE_TIME, None, 0, [], None, bs.PAGODA_LIMIT,
+                bs.DEAD_DETECTORS,
+            )
+            with multiprocessing.Pool(1, bs._worker_init, initargs) as pool:
+                results[corpus][engine] = pool.apply(
+                    _benchmark_task, (engine, boards, budget)
+                )
+
+    return {
+        "sample": sample,
+        "seed": seed,
+        "budget": {
+            "seconds": budget.seconds,
+            "cpu_seconds": budget.cpu_seconds,
+            "nodes": budget.max_nodes,
+            "visited": budget.max_visited,
+        },
+        "results": results,
+    }
+
+
+def benchmark_regressions(current: dict, baseline: dict,
+                          threshold: float = BENCHMARK_THRESHOLD) -> List[str]:
+    """ Compares two benchmark results, returning a line for every figure of
+        current that is worse than baseline's by more than threshold (a fraction
+        of the baseline figure), and for every board that no longer solves
+    """
+    # Whether a larger value of each figure is better
+    figures = {"nodes_per_second": True, "first_solution": False, "peak_memory": False}
+    regressions = []
+    for corpus, engines in current["results"].items():
+        for engine, now in engines.items():
+            before = baseline["results"].get(corpus, {}).get(engine)
+            if before is None:
+                continue
+            name = "{} {}".format(corpus, engine)
+            if now["solved"] < before["solved"]:
+                regressions.append("{}: solved {} boards, down from {}".format(
+                    name, now["solved"], before["solved"]
+                ))
+            for figure, larger_better in figures.items():
+                if not now.get(figure) or not before.get(figure):
+                    continue
+                change = now[figure] / before[figure] - 1
+                if (-change if larger_better else change) > threshold:
+                    regressions.append("{}: {} {:.4g}, was {:.4g} ({:+.0%})".format(
+                        name, figure, now[figure], before[figure], change
+                    ))
+    return regressions
+
+
+def _run_benchmark(baseline_path: str, save: bool, budget: bs.Budget):
+    """ Runs benchmark, printing its figures and any regressions against the
+        baseline file, and exits with status 1 if there are any. With save, the
+        results become the new baseline instead
+    """
+    current = benchmark(budget=budget)
+    for corpus, engines in current["results"].items():
+        for engine, figures in engines.items():
+            first, peak = figures["first_solution"], figures["peak_memory"]
+            print("{} {}: {}/{} solved, {:.0f} nodes/s, first solution {}, "
+                  "peak {}".format(
+                corpus, engine, figures["solved"], figures["boards"],
+                figures["nodes_per_second"],
+                "-" if first is None else "{:.3f}s".format(first),
+                "-" if peak is None else "{:.1f} MiB".format(peak / 2 ** 20),
+            ))
+
+    if save:
+        with open(baseline_path, "w") as f:
+            json.dump(current, f, indent=2)
+        print("Saved baseline to {}".format(baseline_path))
+        return
+    if not os.path.exists(baseline_path):
+        print("No baseline at {}; rerun with --save-baseline to make one".format(
+            baseline_path
+        ))
+        return
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    settings = ("sample", "seed", "budget")
+    if any(baseline.get(setting) != current[setting] for setting in settings):
+        print("Warning: the baseline was run with a different sample, seed or budget")
+    regressions = benchmark_regressions(current, baseline)
+    for line in regressions:
+        print("REGRESSION " + line)
+    if regressions:
+        sys.exit(1)
+    print("No regressions against {}".format(baseline_path))
+
+########################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time every board_solver engine on samples of the shipped board "
+        "files, and flag regressions against a baseline"
+    )
+    parser.add_argument(
+        "baseline", nargs="?", default=BENCHMARK_BASELINE,
+        help="results file to compare against (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--save-baseline", action="store_true",
+        help="save the results as the new baseline instead",
+    )
+    parser.add_argument(
+        "--time", type=float, default=BENCHMARK_TIME,
+        help="wall seconds to spend on each solve (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cpu-time", type=float,
+        help="CPU seconds to spend on each solve (default: no limit)",
+    )
+    parser.add_argument(
+        "--nodes", type=int,
+        help="most positions to expand in each solve (default: no limit)",
+    )
+    parser.add_argument(
+        "--max-visited", type=int,
+        help="most positions a solve may hold at once (default: no limit)",
+    )
+    parser.add_argument(
+        "--pagoda", metavar="N", type=int,
+        help="number of pagoda functions to prune each search with "
+        "(default: {}, which turns pagoda pruning off)".format(bs.PAGODA_LIMIT),
+    )
+    parser.add_argument(
+        "--detector", choices=("isolated", "islands"), action="append",
+        help="check each new position with this dead-position detector (can be "
+        "given once per detector; default: none)",
+    )
+    args = parser.parse_args()
+
+    if args.pagoda is not None:
+        bs.PAGODA_LIMIT = args.pagoda
+    if args.detector is not None:
+        bs.DEAD_DETECTORS = tuple(args.detector)
+    budget = bs.Budget(
+        seconds=args.time, cpu_seconds=args.cpu_time, nodes=args.nodes,
+        visited=args.max_visited,
+    )
+    _run_benchmark(args.baseline, args.save_baseline, budget)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+"""
+board_corpus reads and writes board corpora: packed binary files of boards with
+metadata columns, converted from the text board files board_solver reads, or
+merged from several of them with each board kept once.
+"""
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+from typing import List
+
+import board_solver as bs
+
+# A board corpus file starts with this header: a magic string, the number of boards,
+# the bytes of each wall and peg mask, and the offset and length of the JSON list of
+# metadata columns at the end of the file. The fixed-size records follow at
+# CORPUS_OFFSET
+CORPUS_MAGIC = b"PEGCORP1"
+CORPUS_HEADER = struct.Struct("<8sQIQI")
+CORPUS_OFFSET = 64
+# Bytes per mask in a corpus unless asked otherwise, enough for boards of up to 64
+# cells
+CORPUS_MASK_BYTES = 8
+# The struct format of each type of metadata column. A float column is NaN and a
+# label column (an index into the column's labels) is CORPUS_NO_LABEL where a
+# board has no value
+CORPUS_COLUMN_FORMATS = {"float": "d", "label": "B"}
+CORPUS_NO_LABEL = 255
+
+
+class BoardCorpus:
+    """ A packed file of boards written by write_corpus. Each record holds a
+        board's rows, columns, wall mask and peg mask (cells numbered as in
+        BoardShape), then its metadata columns, so board i is at a fixed offset.
+        The file is memory-mapped read-only, so opening even a very large corpus
+        is instant and reading a board unpacks that record alone.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = CORPUS_HEADER.unpack_from(self.map)
+        magic, self.count, mask_bytes, spec_offset, spec_length = header
+        if magic != CORPUS_MAGIC:
+            raise ValueError("{} is not a board corpus".format(path))
+        spec = self.map[spec_offset:spec_offset + spec_length]
+        self.columns = json.loads(spec.decode())
+        self.record = _corpus_record(mask_bytes, self.columns)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> bs.PegSolitaire:
+        return self.bitboard(i).to_peg_solitaire()
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def _unpack(self, i: int) -> tuple:
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("board {} of a corpus of {}".format(i, self.count))
+        return self.record.unpack_from(self.map, CORPUS_OFFSET + i * self.record.size)
+
+    def bitboard(self, i: int) -> bs.BitBoard:
+        """ Board i as a BitBoard, without building its grid """
+        rows, cols, walls, pegs = self._unpack(i)[:4]
+        shape = bs.get_shape(rows, cols, int.from_bytes(walls, "little"))
+        return bs.BitBoard(shape, int.from_bytes(pegs, "little"))
+
+    def metadata(self, i: int) -> dict:
+        """ The metadata columns of board i, with None where it has no value """
+        values = {}
+        for column, value in zip(self.columns, self._unpack(i)[4:]):
+            if column["type"] == "float":
+                value = None if value != value else value
+            else:
+                value = None if value == CORPUS_NO_LABEL else column["labels"][value]
+            values[column["name"]] = value
+        return values
+
+    def close(self):
+        self.map.close()
+
+
+def _corpus_record(mask_bytes: int, columns: list) -> struct.Struct:
+    formats = "".join(CORPUS_COLUMN_FORMATS[column["type"]] for column in columns)
+    return struct.Struct("<BB{0}s{0}s{1}".format(mask_bytes, formats))
+
+
+def write_corpus(path: str, records, columns: list = (),
+                 mask_bytes: int = CORPUS_MASK_BYTES) -> int:
+    """ Writes a BoardCorpus to path from an iterable of (board, metadata dict)
+        pairs, one at a time, returning how many boards it wrote. columns lists
+        the (name, "float" or "label") metadata columns to keep; a board missing
+        one gets no value for it. The labels of a label column are collected as
+        they come, up to 255 of them
+    """
+    columns = [{"name": name, "type": kind} for name, kind in columns]
+    for column in columns:
+        if column["type"] == "label":
+            column["labels"] = []
+    record = _corpus_record(mask_bytes, columns)
+
+    count = 0
+    with open(path, "wb") as f:
+        f.write(bytes(CORPUS_OFFSET))
+        for board, metadata in records:
+            rows, cols, walls, pegs = bs.board_masks(board)
+            if rows * cols > 8 * mask_bytes:
+                raise ValueError("a {}x{} board doesn't fit in {}-byte masks".format(
+                    rows, cols, mask_bytes
+                ))
+
+            values = []
+            for column in columns:
+                value = metadata.get(column["name"])
+                if column["type"] == "float":
+                    values.append(float("nan") if value is None else value)
+                elif value is None:
+                    values.append(CORPUS_NO_LABEL)
+                else:
+                    if value not in column["labels"]:
+                        if len(column["labels"]) == CORPUS_NO_LABEL:
+                            raise ValueError(
+                                "too many labels in column " + column["name"]
+                            )
+                        column["labels"].append(value)
+                    values.append(column["labels"].index(value))
+
+            f.write(record.pack(
+                rows, cols,
+                walls.to_bytes(mask_bytes, "little"),
+                pegs.to_bytes(mask_bytes, "little"),
+                *values
+            ))
+            count += 1
+
+        spec = json.dumps(columns).encode()
+        spec_offset = f.tell()
+        f.write(spec)
+        f.seek(0)
+        f.write(CORPUS_HEADER.pack(
+            CORPUS_MAGIC, count, mask_bytes, spec_offset, len(spec)
+        ))
+    return count
+
+
+def convert_corpus(source: str, path: str, labels: list = None) -> int:
+    """ Converts a board file to a BoardCorpus at path, returning how many boards
+        it holds. The source can be a file of frozensets (keeping the solve times
+        of a _solvable.txt file as forward_time and backward_time), of JSON grids
+        like easy_medium_hard.txt, or of ASCII boards separated by blank lines like
+        successfull_boards_ascii.txt. labels, if given, is a difficulty label per
+        board, kept as the label column
+    """
+    records, columns = board_records(source)
+    if labels is not None:
+        columns.append(("label", "label"))
+        records = (
+            (board, dict(metadata, label=label))
+            for (board, metadata), label in zip(records, labels)
+        )
+    return write_corpus(path, records, columns)
+
+
+def board_records(source: str):
+    """ The boards of a BoardCorpus or of a file convert_corpus reads, streamed as
+        (board, metadata dict) pairs, along with the write_corpus columns of the
+        metadata
+    """
+    with open(source, "rb") as f:
+        if f.read(len(CORPUS_MAGIC)) == CORPUS_MAGIC:
+            return _corpus_records(source), [
+                (column["name"], column["type"])
+                for column in BoardCorpus(source).columns
+            ]
+    with open(source) as f:
+        first = next((line for line in f if line.strip()), "")
+
+    if first.startswith("frozenset"):
+        times = [("forward_time", "float"), ("backward_time", "float")]
+        return _frozenset_records(source), times
+    elif first.startswith("["):
+        return _json_records(source), []
+    return _ascii_records(source), []
+
+
+def _corpus_records(source: str):
+    corpus = BoardCorpus(source)
+    try:
+        for i in range(len(corpus)):
+            yield corpus.bitboard(i), corpus.metadata(i)
+    finally:
+        corpus.close()
+
+
+def _frozenset_records(source: str):
+    """ The boards of a frozenset file, each with the solve times on the line
+        after it if there are any
+    """
+    board = None
+    with open(source) as f:
+        for line in f:
+            if line.startswith("frozenset"):
+                if board is not None:
+                    yield board, {}
+                board = bs.PegSolitaire(bs.parse_frozen_set(line))
+            elif board is not None and line.strip():
+                forward, backward = map(float, line.split())
+                yield board, {"forward_time": forward, "backward_time": backward}
+                board = None
+    if board is not None:
+        yield board, {}
+
+
+def _json_records(source: str):
+    with open(source) as f:
+        for line in f:
+            if line.strip():
+                yield bs.PegSolitaire(None, json.loads(line)), {}
+
+
+def _ascii_records(source: str):
+    spots = {char: spot for spot, char in bs.ASCII_SPOTS.items()}
+    grid = []
+    with open(source) as f:
+        for line in f:
+            if line.strip():
+                grid.append([spots[char] for char in line.rstrip("\n")])
+            elif grid:
+                yield bs.PegSolitaire(None, grid), {}
+                grid = []
+    if grid:
+        yield bs.PegSolitaire(None, grid), {}
+
+########################################################################################
+
+def board_digest(board: bs.PegSolitaire) -> str:
+    """ The content address of a board: a hash of its canonical form, which is the
+        same for the board and every mirror image and rotation of it, walls and
+        all. Unlike board_solver.board_key, boards whose walls are turned
+        differently match too
+    """
+    rows, cols, walls, pegs = bs.board_masks(board)
+
+    # Turn tall boards on their side, so the symmetries of the blank grid cover
+    # the rest of the rotations
+    if rows > cols:
+        walls, pegs = _transpose(walls, rows, cols), _transpose(pegs, rows, cols)
+        rows, cols = cols, rows
+    symmetries = _grid_symmetries(rows, cols)
+    walls, pegs = min(
+        (_grid_image(walls, tables), _grid_image(pegs, tables)) for tables in symmetries
+    )
+    key = "{}x{}:{:x}:{:x}".format(rows, cols, walls, pegs)
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+# The symmetries of each blank grid size board_digest has seen, as byte lookup
+# tables. Unlike board_solver._SHAPES this only grows with the grid sizes, not the
+# wall layouts
+_GRID_SYMMETRIES = {}
+
+
+def _grid_symmetries(rows: int, cols: int) -> List[List[List[int]]]:
+    """ The symmetries of a blank rows x cols grid, each as a table per byte of a
+        mask from that byte's bits to their image
+    """
+    key = (rows, cols)
+    if key not in _GRID_SYMMETRIES:
+        symmetries = []
+        for _, transform in bs.BoardShape._transforms(rows, cols):
+            images = [
+                1 << (x * cols + y)
+                for x, y in (
+                    transform(*divmod(cell, cols)) for cell in range(rows * cols)
+                )
+            ]
+            tables = []
+            for first in range(0, rows * cols, 8):
+                chunk = images[first:first + 8]
+                table = [0] * (1 << len(chunk))
+                for bits in range(1, len(table)):
+                    low = bits & -bits
+                    table[bits] = table[bits ^ low] | chunk[low.bit_length() - 1]
+                tables.append(table)
+            symmetries.append(tables)
+        _GRID_SYMMETRIES[key] = symmetries
+    return _GRID_SYMMETRIES[key]
+
+
+def _grid_image(mask: int, tables: List[List[int]]) -> int:
+    """ A mask turned by one of the symmetries from _grid_symmetries """
+    image = 0
+    for table in tables:
+        image |= table[mask & 0xFF]
+        mask >>= 8
+    return image
+
+
+def _transpose(mask: int, rows: int, cols: int) -> int:
+    """ A mask of a rows x cols grid as the mask of its cols x rows transpose """
+    transposed = 0
+    while mask:
+        low = mask & -mask
+        x, y = divmod(low.bit_length() - 1, cols)
+        transposed |= 1 << (y * rows + x)
+        mask ^= low
+    return transposed
+
+
+def dedupe_boards(sources: list, path: str, seen: str = None) -> dict:
+    """ Merges board files (anything board_records reads) into one BoardCorpus at
+        path that holds each board only once, however many times it or its mirror
+        images and rotations turn up. Boards are streamed one at a time and their
+        board_digest kept in a SQLite file, so memory stays bounded however many
+        there are. Pass seen to keep that file, so a later merge also leaves out
+        every board merged before.
+
+        The corpus keeps each board's source file as the source column, along with
+        any solve times. Returns, per source file, a dict of:
+            boards: boards read
+            duplicates: boards already seen, in this file or an earlier one
+            within: duplicates first seen in this same file
+            rate: duplicates / boards
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        connection = sqlite3.connect(seen or os.path.join(directory, "seen.db"))
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS seen (digest TEXT PRIMARY KEY, source TEXT)"
+        )
+        report = {}
+
+        def unique():
+            for source in sources:
+                counts = report[source] = {"boards": 0, "duplicates": 0, "within": 0}
+                for board, metadata in board_records(source)[0]:
+                    counts["boards"] += 1
+                    digest = board_digest(board)
+                    added = connection.execute(
+                        "INSERT OR IGNORE INTO seen VALUES (?, ?)", (digest, source)
+                    ).rowcount
+                    if added:
+                        yield board, dict(metadata, source=source)
+                        continue
+                    counts["duplicates"] += 1
+                    first = connection.execute(
+                        "SELECT source FROM seen WHERE digest = ?", (digest,)
+                    ).fetchone()[0]
+                    counts["within"] += first == source
+                connection.commit()
+                counts["rate"] = counts["duplicates"] / max(counts["boards"], 1)
+
+        columns = [
+            ("source", "label"), ("forward_time", "float"), ("backward_time", "float"),
+        ]
+        try:
+            write_corpus(path, unique(), columns)
+        finally:
+            connection.close()
+    return report
+
+########################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a board file (frozensets, JSON grids or ASCII boards) "
+        "to a binary board corpus"
+    )
+    parser.add_argument("input_file", help="board file to convert")
+    parser.add_argument("output", help="path of the corpus to write")
+    parser.add_argument(
+        "--dedupe", action="store_true",
+        help="merge the input file and every --merge file into the corpus, holding "
+        "each board once (up to mirror images and rotations), and report the "
+        "duplicate rate of each file",
+    )
+    parser.add_argument(
+        "--merge", metavar="FILE", action="append", default=[],
+        help="another board file for --dedupe (can be given more than once)",
+    )
+    parser.add_argument(
+        "--seen", metavar="PATH",
+        help="with --dedupe, keep the digests of merged boards in this file and "
+        "leave out boards merged in earlier runs",
+    )
+    args = parser.parse_args()
+
+    if not args.dedupe:
+        count = convert_corpus(args.input_file, args.output)
+        print("Wrote {} boards to {}".format(count, args.output))
+        return
+
+    report = dedupe_boards([args.input_file] + args.merge, args.output, args.seen)
+    for source, counts in report.items():
+        print("{}: {} boards, {} duplicates ({} within the file), {:.1%}".format(
+            source, counts["boards"], counts["duplicates"], counts["within"],
+            counts["rate"],
+        ))
+
+
+if __name__ == "__main__":
+    main()
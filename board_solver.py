@@ -4,15 +4,43 @@ board_solver has all utility classes for making the peg solitaire game boards.
 By: Spencer Chang, Jacob Marshall
 """
 
+import argparse
+import array
+import cProfile
+import heapq
+import itertools
+import json
+import mmap
+import multiprocessing
+import operator
 import os
+import pstats
+import re
+import sqlite3
+import struct
 import sys
+import tempfile
+import threading
 # import termios
 import time
 # import tty
+from collections import OrderedDict
 from pprint import pprint, pformat
-from queue import PriorityQueue
 # from termcolor import cprint
-from typing import FrozenSet, List, Tuple
+from typing import FrozenSet, Iterable, Iterator, List, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    # layered_solve falls back to Python sets of ints without it
+    np = None
+
+# The number of set bits of a mask. int.bit_count only exists from Python 3.10
+if hasattr(int, "bit_count"):
+    popcount = int.bit_count
+else:
+    def popcount(mask: int) -> int:
+        return bin(mask).count("1")
 
 
 HOLE = 0
@@ -23,6 +51,53 @@ X = 0
 Y = 0
 
 BOARD_SOLVE_TIME = 75
+# How many nodes a search expands between checks of its Budget
+BUDGET_CHECK_INTERVAL = 1024
+# How many positions dfs_solve remembers as unsolvable before it starts forgetting
+# the least recently used ones
+DEAD_CACHE_SIZE = 1000000
+# How many positions bidirectional_solve gathers in its last backward layer before
+# it starts the forward search
+MEET_LAYER_SIZE = 30000
+# How many positions of a layer layered_solve expands at once with NumPy, which
+# bounds the memory the children take before duplicates are dropped
+LAYER_CHUNK_SIZE = 1 << 18
+# How many positions build_solvability_db writes per layer file
+LAYER_FILE_SIZE = 1 << 24
+# How many results a SolveCache keeps before dropping the least recently used
+SOLVE_CACHE_SIZE = 100000
+# How many pagoda functions a search checks every new position against when the
+# engine isn't given a pagoda_limit (0 turns pagoda pruning off). Off by default:
+# on the shipped boards the functions cut very few positions (8 of about 3 million
+# generated) and checking them made the searches 5-10% slower. The cuts in
+# SearchStats show what they do elsewhere
+PAGODA_LIMIT = 0
+# The dead-position detectors searches check every new position with when the
+# engine isn't given detectors (see BoardShape.dead_detector); an empty tuple, the
+# default, turns them off. On 120
+# sample boards "isolated" cut the children a_star_solve generated by a quarter
+# yet made it 15% slower, and "islands" 90%, so they are left for boards where
+# the cuts in SearchStats show they pay off
+DEAD_DETECTORS = ()
+# How many finished boards a RunJournal holds before writing them out together
+JOURNAL_BATCH = 10
+# How many boards main() reads and screens with bialostocki_filter at a time
+FILTER_BATCH = 1000
+# How many functions merge_profiles lists in its summary
+PROFILE_TOP = 40
+# The atoms of a clyngor frozenset that PegSolitaire builds a board from; every
+# other atom on the line (x, y, z, noneighbor, crossarea, ...) is skipped
+BOARD_ATOM = re.compile(
+    r"""\(\s*['"](size|peg|out|linked)['"]\s*,"""
+    r"""\s*\(\s*(\d+)\s*,\s*(\d+)\s*\)\s*\)"""
+)
+# A board file's offset index (board_offsets) is kept next to it with this suffix.
+# It starts with this header: a magic string, then the size and modification time
+# (in ns) of the file it was built from and the number of boards. The byte offset
+# of each board follows, as 8-byte integers
+BOARD_INDEX_SUFFIX = ".idx"
+BOARD_INDEX_MAGIC = b"PEGIDX01"
+BOARD_INDEX_HEADER = struct.Struct("<8sQQQ")
 # Define new types for this file
 BoardSet = FrozenSet[Tuple[str, Tuple[int, int]]]
 CompleteBoard = List[List[int]]
@@ -77,7 +152,15 @@ class PegSolitaire:
 
     def copy(self):
         """ Returns a copy of the current board """
-        return PegSolitaire(None, [x[:] for x in self.board])
+        new = PegSolitaire(None, [x[:] for x in self.board])
+
+        # Hand over the bookkeeping so the copy doesn't have to rescan the board
+        if getattr(self, "_tracked_board", None) is self.board:
+            new._peg_count = self._peg_count
+            new._peg_mask = self._peg_mask
+            new._holes = set(self._holes)
+            new._tracked_board = new.board
+        return new
 
 ########################################################################################
 
@@ -112,7 +195,46 @@ class PegSolitaire:
 ########################################################################################
 
     def __hash__(self):
-        return hash(tuple([tuple(b) for b in self.board]))
+        self._track()
+        return hash(self._peg_mask)
+
+########################################################################################
+
+    def _track(self):
+        """ Makes sure the peg count, hole set and peg mask match self.board. They are
+            built by one scan of the board and then kept up to date by perform_move
+            and undo_move, so they are only rebuilt if self.board is swapped out.
+
+            NOTE: Writing to board[x][y] directly bypasses this bookkeeping
+        """
+        if getattr(self, "_tracked_board", None) is self.board:
+            return
+
+        cols = len(self.board[0])
+        self._peg_count = 0
+        self._peg_mask = 0
+        self._holes = set()
+        for i, row in enumerate(self.board):
+            for j, spot in enumerate(row):
+                if spot == PEG:
+                    self._peg_count += 1
+                    self._peg_mask |= 1 << (i * cols + j)
+                elif spot == HOLE:
+                    self._holes.add((i, j))
+        self._tracked_board = self.board
+
+########################################################################################
+
+    def _flip(self, x: int, y: int, spot: int):
+        """ Sets one spot on the board and updates the bookkeeping to match """
+        self.board[x][y] = spot
+        self._peg_mask ^= 1 << (x * len(self.board[0]) + y)
+        if spot == PEG:
+            self._peg_count += 1
+            self._holes.discard((x, y))
+        else:
+            self._peg_count -= 1
+            self._holes.add((x, y))
 
 ########################################################################################
 
@@ -122,63 +244,69 @@ class PegSolitaire:
 
             NOTE: This does NO error checking. It assumes the move is valid
         """
-        # Place a peg in the new location
-        self.board[x2][y2] = PEG
+        self._track()
+        self._flip(x2, y2, PEG)
+        self._flip((x1 + x2) // 2, (y1 + y2) // 2, HOLE)
+        self._flip(x1, y1, HOLE)
 
-        # Find out which peg you have to remove
-        if x1 < x2:  # Remove peg from above hole
-            self.board[x2 - 1][y2] = HOLE
-        elif x1 > x2:  # Remove peg from below hole
-            self.board[x2 + 1][y2] = HOLE
-        elif y1 < y2:  # Remove peg from left of hole
-            self.board[x2][y2 - 1] = HOLE
-        elif y1 > y2:  # Remove peg from right of hole
-            self.board[x2][y2 + 1] = HOLE
+########################################################################################
 
-        # Remove old peg from its former position
-        self.board[x1][y1] = HOLE
+    def undo_move(self, x1: int, y1: int, x2: int, y2: int):
+        """ Takes back a move made by perform_move with the same coordinates, so a
+            search can walk down and back up a single board without copying it
+        """
+        self._track()
+        self._flip(x1, y1, PEG)
+        self._flip((x1 + x2) // 2, (y1 + y2) // 2, PEG)
+        self._flip(x2, y2, HOLE)
 
 ########################################################################################
 
     def total_moves(self):
         """ Will return a list of available moves on a board """
         moves = []
+        board = self.board
 
-        holes = self._find_holes()
-
-        for hole in holes:
-            # The '*' in this function call expands the tuple into two arguments
-            moves += self._find_moves_around_hole(*hole)
+        # Only the jumps that fit this board's walls are ever checked
+        for (x1, y1), (x, y), (x2, y2) in self.shape.moves:
+            if board[x2][y2] == HOLE and board[x][y] == PEG and board[x1][y1] == PEG:
+                moves.append((x1, y1, x2, y2))
 
         return moves
 
+########################################################################################
+
+    @property
+    def shape(self) -> "BoardShape":
+        """ The cached BoardShape matching this board's walls. It is looked up again
+            whenever self.board is swapped out, e.g. for reverse_board
+        """
+        if getattr(self, "_shape_board", None) is not self.board:
+            rows, cols = len(self.board), len(self.board[0])
+            walls = 0
+            for x, row in enumerate(self.board):
+                for y, spot in enumerate(row):
+                    if spot == WALL:
+                        walls |= 1 << (x * cols + y)
+            self._shape = get_shape(rows, cols, walls)
+            self._shape_board = self.board
+        return self._shape
+
 ########################################################################################
 
     def pegs_remaining(self) -> int:
         """ Returns the total amount of remaining pegs. This is used as a heuristic
             for checking if the board is solvable
         """
-        peg_count = 0
-        for row in self.board:
-            for spot in row:
-                if spot == PEG:
-                    peg_count += 1
-        return peg_count
+        self._track()
+        return self._peg_count
 
 ########################################################################################
 
     def _find_holes(self) -> List[Tuple[int, int]]:
-        """ Will traverse through a game board a return a list of all the holes """
-        holes = []
-
-        # Go through entire board
-        for i, row in enumerate(self.board):
-            for j, spot in enumerate(row):
-                # If you find a hole, add a tuple of the x,y coordinate to a list
-                if spot == HOLE:
-                    holes.append((i, j))
-
-        return holes
+        """ Will return a list of all the holes, in row order """
+        self._track()
+        return sorted(self._holes)
 
 ########################################################################################
 
@@ -231,165 +359,2784 @@ class PegSolitaire:
 ########################################################################################
 ########################################################################################
 
-def process_frozen_sets(input_file: str) -> BoardSet:
-    boards = []
+# Jump directions as (row step, column step). The order matches the order
+# PegSolitaire._find_moves_around_hole looks around a hole: a peg coming from the
+# right, from the left, from above and from below
+DIRECTIONS = ((0, -1), (0, 1), (1, 0), (-1, 0))
+
+
+def _shift(mask: int, shift: int) -> int:
+    """ Moves every bit of mask shift cells up (or down, if shift is negative) """
+    return mask << shift if shift >= 0 else mask >> -shift
+
+
+class BoardShape:
+    """ The part of a board that never changes during a solve: its dimensions and
+        which cells are walls. Cells are numbered row by row, so cell (x, y) is bit
+        x * cols + y of every mask.
+    """
+
+    def __init__(self, rows: int, cols: int, walls: int):
+        self.rows = rows
+        self.cols = cols
+        self.walls = walls
+        self.cells = ((1 << (rows * cols)) - 1) & ~walls
+
+        # Every jump that stays on the board, as ((x, y) from, over, to) triples,
+        # listed hole by hole in the same order _find_moves_around_hole uses
+        self.moves = []
+        for x in range(rows):
+            for y in range(cols):
+                for dx, dy in DIRECTIONS:
+                    x1, y1 = x - 2 * dx, y - 2 * dy
+                    if not (0 <= x1 < rows and 0 <= y1 < cols):
+                        continue
+                    if all(self.is_cell(x - k * dx, y - k * dy) for k in range(3)):
+                        self.moves.append(((x1, y1), (x - dx, y - dy), (x, y)))
+
+        # The same moves grouped by direction so a whole direction can be tested
+        # with a few shifts: the shift from the jumping peg to the peg it jumps
+        # over, the mask of holes a jump in this direction can land in, and the
+        # (x1, y1, x2, y2) move for each landing cell
+        self.jumps = []
+        for dx, dy in DIRECTIONS:
+            landings = 0
+            by_dest = {}
+            for source, over, dest in self.moves:
+                if (dest[0] - over[0], dest[1] - over[1]) == (dx, dy):
+                    landings |= self.bit(*dest)
+                    by_dest[dest[0] * cols + dest[1]] = source + dest
+            self.jumps.append((dx * cols + dy, landings, by_dest))
+
+        # Neighbour masks for dead_detector, per direction of DIRECTIONS: the
+        # cells a jump can land in, the cells whose peg can take part in a jump
+        # if the cell one step back has a peg (jumping in the opposite direction,
+        # or being jumped in this one), and the cells next to the following cell
+        # in some jump
+        landings_of = {shift: landings for shift, landings, _ in self.jumps}
+        self.neighbours = tuple(
+            (
+                landings,
+                _shift(landings, -shift) | _shift(landings_of[-shift], 2 * shift),
+                _shift(landings, -2 * shift) | _shift(landings, -shift),
+            )
+            for shift, landings, _ in self.jumps
+        )
+
+        # The mirror images and rotations that map the walls onto themselves. Each
+        # one is stored as four lookup tables, one per quarter of the cells, from
+        # that quarter's bits to their transformed bits, so a board is transformed
+        # in four lookups
+        self.chunk_bits = -(-(rows * cols) // 4)
+        self.symmetries = []
+        self.symmetry_names = []
+        self.symmetry_maps = []
+        for name, transform in self._transforms(rows, cols):
+            image = 0
+            for x in range(rows):
+                for y in range(cols):
+                    if walls & self.bit(x, y):
+                        image |= self.bit(*transform(x, y))
+            if image != walls:
+                continue
+
+            images = [
+                self.bit(*transform(*divmod(cell, cols))) for cell in range(rows * cols)
+            ]
+            self.symmetries.append(self.chunk_tables(images, operator.or_))
+            self.symmetry_names.append(name)
+            self.symmetry_maps.append({
+                (x, y): transform(x, y) for x in range(rows) for y in range(cols)
+            })
+
+        # A jump XORs three cells into the peg mask, so it XORs the images of those
+        # cells into every symmetric image of the mask. Keeping the images of each
+        # jump lets a search update a position's images instead of recomputing them
+        self.move_images = {}
+        for source, over, dest in self.moves:
+            flipped = self.bit(*source) | self.bit(*over) | self.bit(*dest)
+            self.move_images[source + dest] = tuple(
+                self.transform(flipped, i) for i in range(len(self.symmetries))
+            )
+
+        # Cells coloured by (x + y) % 3 and by (x - y) % 3, one mask per colour.
+        # A jump covers one cell of each colour in both colourings (position_class)
+        self.diagonals = []
+        for colour_of in (lambda x, y: (x + y) % 3, lambda x, y: (x - y) % 3):
+            masks = [0, 0, 0]
+            for x in range(rows):
+                for y in range(cols):
+                    if self.is_cell(x, y):
+                        masks[colour_of(x, y)] |= self.bit(x, y)
+            self.diagonals.append(masks)
+
+        # The position classes a single peg can have; see position_class
+        self.final_classes = {
+            self.position_class(self.bit(x, y))
+            for x in range(rows) for y in range(cols) if self.is_cell(x, y)
+        }
+
+        # The pagoda functions that hold on this shape's moves
+        self.pagodas = [p for p in self._pagoda_candidates() if p.holds()]
+
+    def dead_detector(self, pegs: int, detectors=None) -> str:
+        """ The name of the first of detectors (DEAD_DETECTORS if not given) that
+            proves a position with more
+            than one peg can't be solved, or None. Both work from the cells a peg
+            could ever reach: starting from the pegs, any cell a jump between two
+            reachable cells lands in. This ignores the pegs that jumps remove, so
+            it only ever reaches too many cells.
+
+            isolated: a peg that can never jump or be jumped, since no reachable
+                cell is next to it in a jump. It will be on the board at the end
+                along with some other peg
+            islands: pegs in parts of the reachable cells that never share a
+                jump. Every jump stays in one part, so each keeps a peg to the
+                end, however the pegs of a part merge
+
+            The pegs themselves are reachable, so the reachable cells are only
+            grown as far as it takes to clear the pegs
+        """
+        if detectors is None:
+            detectors = DEAD_DETECTORS
+        if not detectors or pegs & (pegs - 1) == 0:
+            return None
+
+        reach = pegs
+        if "isolated" in detectors:
+            stuck = pegs & ~self._movable(reach)
+            while stuck:
+                grown = self._grow(reach)
+                if grown == reach:
+                    return "isolated"
+                reach = grown
+                stuck &= ~self._movable(reach)
+        if "islands" in detectors:
+            while pegs & ~self._part(pegs, reach):
+                grown = self._grow(reach)
+                if grown == reach:
+                    return "islands"
+                reach = grown
+        return None
+
+    # The helpers of dead_detector spell out the four DIRECTIONS (left, right,
+    # down, up), since they run on every new position of a search
+
+    def _grow(self, r: int) -> int:
+        """ r plus the cells a jump between two cells of r lands in """
+        (left, _, _), (right, _, _), (down, _, _), (up, _, _) = self.neighbours
+        c, c2 = self.cols, 2 * self.cols
+        r |= left & (r >> 1) & (r >> 2)
+        r |= right & (r << 1) & (r << 2)
+        r |= down & (r << c) & (r << c2)
+        r |= up & (r >> c) & (r >> c2)
+        return r
+
+    def _movable(self, r: int) -> int:
+        """ The cells whose peg could take part in a jump, given the reachable
+            cells r
+        """
+        (_, left, _), (_, right, _), (_, down, _), (_, up, _) = self.neighbours
+        c = self.cols
+        return left & (r >> 1) | right & (r << 1) | down & (r << c) | up & (r >> c)
+
+    def _part(self, pegs: int, reach: int) -> int:
+        """ The cells of reach linked to the lowest peg by a chain of jumps """
+        (_, _, left), (_, _, right), (_, _, down), (_, _, up) = self.neighbours
+        c = self.cols
+        part = pegs & -pegs
+        while True:
+            grown = reach & (
+                part | (part & left) >> 1 | (part & right) << 1
+                | (part & down) << c | (part & up) >> c
+            )
+            if grown == part:
+                return part
+            part = grown
+
+    def chunk_tables(self, values: List[int], combine) -> List[List[int]]:
+        """ Splits the cells into four chunks and builds a table per chunk from the
+            chunk's bits to combine() of the values of the cells whose bits are set,
+            so a function of a whole mask costs four lookups
+        """
+        # Always four, even when a grid of a few cells (9, say) runs out of cells
+        # first; the chunks past the end are empty and their tables just [0]
+        tables = []
+        for first in range(0, 4 * self.chunk_bits, self.chunk_bits):
+            chunk = values[first:first + self.chunk_bits]
+
+            # Each entry is the entry without its lowest bit plus that bit's value
+            table = [0] * (1 << len(chunk))
+            for bits in range(1, len(table)):
+                low = bits & -bits
+                table[bits] = combine(table[bits ^ low], chunk[low.bit_length() - 1])
+            tables.append(table)
+        return tables
+
+    def __reduce__(self):
+        # The tables are rebuilt (or found in _SHAPES) rather than pickled, which
+        # is both smaller and the only way the worker processes of batch_solve
+        # get the shared instance for the layout
+        return get_shape, (self.rows, self.cols, self.walls)
+
+    @staticmethod
+    def _transforms(rows: int, cols: int):
+        """ The symmetries of an empty rows x cols grid, as (x, y) -> (x, y)
+            functions. A square grid has all eight; a rectangle only has four
+        """
+        r, c = rows - 1, cols - 1
+        transforms = [
+            ("identity", lambda x, y: (x, y)),
+            ("flip_columns", lambda x, y: (x, c - y)),
+            ("flip_rows", lambda x, y: (r - x, y)),
+            ("rotate_180", lambda x, y: (r - x, c - y)),
+        ]
+        if rows == cols:
+            transforms += [
+                ("transpose", lambda x, y: (y, x)),
+                ("rotate_90", lambda x, y: (y, r - x)),
+                ("rotate_270", lambda x, y: (c - y, x)),
+                ("anti_transpose", lambda x, y: (c - y, r - x)),
+            ]
+        return transforms
+
+    def transform(self, pegs: int, symmetry: int) -> int:
+        """ Applies self.symmetries[symmetry] to a peg mask """
+        return self._apply(pegs, self.symmetries[symmetry:symmetry + 1])[0]
+
+    def images(self, pegs: int) -> List[int]:
+        """ Every symmetric image of a peg mask, in the order of self.symmetries
+            (the identity comes first)
+        """
+        return [pegs] + self._apply(pegs, self.symmetries[1:])
+
+    def _apply(self, pegs: int, symmetries) -> List[int]:
+        bits = self.chunk_bits
+        mask = (1 << bits) - 1
+        c0, c1 = pegs & mask, (pegs >> bits) & mask
+        c2, c3 = (pegs >> 2 * bits) & mask, pegs >> 3 * bits
+        return [t0[c0] | t1[c1] | t2[c2] | t3[c3] for t0, t1, t2, t3 in symmetries]
+
+    def turn(self, pegs: int, target: int) -> dict:
+        """ The (x, y) -> (x, y) dict of a symmetry that turns the position pegs
+            into target, which has to be one of its images
+        """
+        return self.symmetry_maps[self.images(pegs).index(target)]
+
+    def canonical(self, pegs: int) -> int:
+        """ The smallest peg mask among all the symmetric images of this one. Two
+            positions that are mirror images or rotations of each other on this
+            shape have the same canonical mask
+        """
+        if len(self.symmetries) == 1:
+            return pegs
+        return min(self.images(pegs))
+
+    def position_class(self, pegs: int) -> int:
+        """ A jump covers three cells in a line, one of each colour in both diagonal
+            colourings, so it flips the parity of the peg count of every colour.
+            Comparing those parities pairwise gives two bits per colouring that no
+            jump can change; this packs all four into one number
+        """
+        signature = 0
+        for colours in self.diagonals:
+            p0, p1, p2 = [popcount(pegs & mask) & 1 for mask in colours]
+            signature = (signature << 2) | ((p0 ^ p1) << 1) | (p1 ^ p2)
+        return signature
+
+    def final_cells(self, pegs: int) -> List[int]:
+        """ The cell numbers the last peg could end up on, going by position_class """
+        signature = self.position_class(pegs)
+        return [
+            cell for cell in range(self.rows * self.cols)
+            if self.cells >> cell & 1 and self.position_class(1 << cell) == signature
+        ]
+
+    def _pagoda_candidates(self) -> List["Pagoda"]:
+        """ Pagoda functions built from Fibonacci numbers growing along the rows or
+            the columns from an offset, and the sums of a row one and a column one,
+            which grow towards a corner. Before the offset the weights are either
+            all 1 (1, 1, 1, 2, 3, 5 ...) or alternate 1 and 0 (0, 1, 0, 1, 1, 2 ...).
+            No jump along the growing direction increases such a total since
+            F(n) = F(n-1) + F(n-2), and jumps across it don't change it
+        """
+        fibonacci = [1, 1]
+        while len(fibonacci) < max(self.rows, self.cols):
+            fibonacci.append(fibonacci[-1] + fibonacci[-2])
+
+        def profiles(length, axis):
+            found = []
+            for offset in range(length - 2):
+                flat = [fibonacci[max(0, i - offset)] for i in range(length)]
+                alternating = [
+                    fibonacci[i - offset] if i >= offset else (offset - i) % 2
+                    for i in range(length)
+                ]
+                for kind, growing in (("", flat), ("~", alternating)):
+                    found.append(("{}+{}{}".format(axis, kind, offset), growing))
+                    found.append(("{}-{}{}".format(axis, kind, offset), growing[::-1]))
+            return found
+
+        by_row = profiles(self.rows, "x")
+        by_col = profiles(self.cols, "y")
+        cells = [divmod(cell, self.cols) for cell in range(self.rows * self.cols)]
+
+        candidates = []
+        for name, f in by_row:
+            candidates.append(Pagoda(name, self, [f[x] for x, y in cells]))
+        for name, g in by_col:
+            candidates.append(Pagoda(name, self, [g[y] for x, y in cells]))
+        for row_name, f in by_row:
+            for col_name, g in by_col:
+                candidates.append(Pagoda(
+                    row_name + "," + col_name, self, [f[x] + g[y] for x, y in cells]
+                ))
+        return candidates
+
+    def pagoda_checks(self, pegs: int, limit: int = None):
+        """ Picks the pagoda functions most likely to cut branches in a search from
+            this position. Returns (Pagoda, threshold) pairs: a position whose value
+            is below the threshold can't be solved, because the threshold is the
+            lowest weight of any cell the last peg could end up on.
+
+            Functions are ranked by threshold over starting value, since the closer
+            the start already is to its threshold, the sooner branches fall below it
+        """
+        if limit is None:
+            limit = PAGODA_LIMIT
+        finals = self.final_cells(pegs)
+        if not finals:
+            return []
+
+        ranked = []
+        for pagoda in self.pagodas:
+            # A function whose threshold is the lowest weight on the board can never
+            # cut anything, since a position with any peg left reaches it
+            threshold = min(pagoda.weights[cell] for cell in finals)
+            lowest = min(
+                w for cell, w in enumerate(pagoda.weights) if self.cells >> cell & 1
+            )
+            if threshold <= lowest:
+                continue
+            start = sum(w for cell, w in enumerate(pagoda.weights) if pegs >> cell & 1)
+            ratio = threshold / start if start else float("inf")
+            ranked.append((ratio, pagoda, threshold))
+        ranked.sort(key=lambda entry: -entry[0])
+        return [(pagoda, threshold) for _, pagoda, threshold in ranked[:limit]]
+
+    def bit(self, x: int, y: int) -> int:
+        return 1 << (x * self.cols + y)
+
+    def is_cell(self, x: int, y: int) -> bool:
+        return not self.walls & self.bit(x, y)
+
+    def __eq__(self, other):
+        return ((self.rows, self.cols, self.walls)
+                == (other.rows, other.cols, other.walls))
+
+    def __hash__(self):
+        return hash((self.rows, self.cols, self.walls))
+
+
+class Pagoda:
+    """ A pagoda function: a weight for every cell such that no jump can increase
+        the total weight of the pegs, i.e. the landing cell never weighs more than
+        the two cells the jump empties. The total can only go down during a game,
+        so a position whose total is already below the weight of every cell the
+        last peg could finish on can never be solved.
+    """
+
+    def __init__(self, name: str, shape: BoardShape, weights: List[int]):
+        self.name = name
+        self.shape = shape
+        self.weights = weights
+        self._tables = None
+
+        # How much each (x1, y1, x2, y2) move changes the total
+        self.deltas = {}
+        for source, over, dest in shape.moves:
+            self.deltas[source + dest] = (
+                weights[dest[0] * shape.cols + dest[1]]
+                - weights[source[0] * shape.cols + source[1]]
+                - weights[over[0] * shape.cols + over[1]]
+            )
+
+    def holds(self) -> bool:
+        """ Whether no move on the shape increases the total """
+        return all(delta <= 0 for delta in self.deltas.values())
+
+    def value(self, pegs: int) -> int:
+        """ The total weight of the pegs. The lookup tables are only built for the
+            functions a search actually uses
+        """
+        if self._tables is None:
+            self._tables = self.shape.chunk_tables(self.weights, operator.add)
+        t0, t1, t2, t3 = self._tables
+        bits = self.shape.chunk_bits
+        mask = (1 << bits) - 1
+        return (t0[pegs & mask] + t1[(pegs >> bits) & mask]
+                + t2[(pegs >> 2 * bits) & mask] + t3[pegs >> 3 * bits])
+
+    def __repr__(self):
+        return "Pagoda({})".format(self.name)
+
+
+# Every board with the same wall layout shares one BoardShape, so the move table is
+# only built once per shape no matter how many boards use it
+_SHAPES = {}
+
+
+def get_shape(rows: int, cols: int, walls: int) -> BoardShape:
+    """ Returns the cached BoardShape for this wall layout, building it if needed """
+    key = (rows, cols, walls)
+    if key not in _SHAPES:
+        _SHAPES[key] = BoardShape(rows, cols, walls)
+    return _SHAPES[key]
+
+########################################################################################
+########################################################################################
+########################################################################################
+
+class BitBoard:
+    """ A compact peg solitaire position: a BoardShape plus one integer holding a set
+        bit for every peg. Copying, hashing and counting pegs are all single integer
+        operations, which is what the solvers spend most of their time on.
+
+        Indexing (board[x][y]) gives the same HOLE/PEG/WALL values as PegSolitaire,
+        but the rows are built on demand and writing to them does not change the
+        board.
+    """
+
+    __slots__ = ("shape", "pegs", "count")
+
+    def __init__(self, shape: BoardShape, pegs: int, count: int = None):
+        self.shape = shape
+        self.pegs = pegs
+        # The number of pegs is kept up to date by perform_move and undo_move
+        self.count = popcount(pegs) if count is None else count
+
+    @classmethod
+    def from_board(cls, board) -> "BitBoard":
+        """ Builds a BitBoard from a PegSolitaire or a CompleteBoard """
+        if isinstance(board, BitBoard):
+            return board.copy()
+        if isinstance(board, PegSolitaire):
+            board = board.board
+
+        rows, cols, walls, pegs = board_masks(board)
+        return cls(get_shape(rows, cols, walls), pegs)
+
+    def to_peg_solitaire(self) -> PegSolitaire:
+        return PegSolitaire(None, self.board)
+
+########################################################################################
 
+    @property
+    def width(self) -> int:
+        return self.shape.cols - 1
+
+    @property
+    def height(self) -> int:
+        return self.shape.rows - 1
+
+    @property
+    def board(self) -> CompleteBoard:
+        return [self[x] for x in range(self.shape.rows)]
+
+    @property
+    def holes(self) -> int:
+        """ Mask of the empty cells; the walls never change, so this is always one
+            operation away from the peg mask
+        """
+        return self.shape.cells & ~self.pegs
+
+    @property
+    def reverse_board(self) -> CompleteBoard:
+        return [row[::-1] for row in self.board[::-1]]
+
+########################################################################################
+
+    def copy(self):
+        """ Returns a copy of the current board """
+        return BitBoard(self.shape, self.pegs, self.count)
+
+########################################################################################
+
+    def __getitem__(self, key: int) -> List[int]:
+        cols = self.shape.cols
+        row = []
+        for y in range(cols):
+            bit = 1 << (key * cols + y)
+            if self.shape.walls & bit:
+                row.append(WALL)
+            elif self.pegs & bit:
+                row.append(PEG)
+            else:
+                row.append(HOLE)
+        return row
+
+    def __iter__(self):
+        return iter(self.board)
+
+    def __repr__(self):
+        return pformat(self.board)
+
+    def __lt__(self, other):
+        return self.count < other.count
+
+    def __eq__(self, other):
+        return self.pegs == other.pegs and self.shape == other.shape
+
+    def __hash__(self):
+        return hash(self.pegs)
+
+########################################################################################
+
+    def perform_move(self, x1: int, y1: int, x2: int, y2: int):
+        """ Same as PegSolitaire.perform_move. A jump flips the source, the jumped
+            peg and the destination, so it is a single XOR.
+
+            NOTE: This does NO error checking. It assumes the move is valid
+        """
+        cols = self.shape.cols
+        source = x1 * cols + y1
+        dest = x2 * cols + y2
+        self.pegs ^= (1 << source) | (1 << ((source + dest) // 2)) | (1 << dest)
+        self.count -= 1
+
+########################################################################################
+
+    def undo_move(self, x1: int, y1: int, x2: int, y2: int):
+        """ Takes back a move made by perform_move with the same coordinates. The
+            XOR is its own inverse, so only the peg count needs special handling
+        """
+        cols = self.shape.cols
+        source = x1 * cols + y1
+        dest = x2 * cols + y2
+        self.pegs ^= (1 << source) | (1 << ((source + dest) // 2)) | (1 << dest)
+        self.count += 1
+
+########################################################################################
+
+    def total_moves(self):
+        """ Will return a list of available moves on a board, in the same
+            (x1, y1, x2, y2) form as PegSolitaire.total_moves
+        """
+        return self._jumps(self.holes, self.pegs)
+
+    def reverse_moves(self):
+        """ Will return a list of the moves that could have led to this board: a
+            peg on the landing cell and holes on the two cells it came over and
+            from. Each is given as the (x1, y1, x2, y2) move it undoes
+        """
+        return self._jumps(self.pegs, self.holes)
+
+    def _jumps(self, holes: int, pegs: int):
+        """ The moves that land on a cell of holes after jumping over and from cells
+            of pegs
+        """
+        # For each direction, find every hole with a peg next to it and another
+        # peg after that, all at once
+        found = []
+        landed = 0
+        for step, landings, by_dest in self.shape.jumps:
+            if step > 0:
+                dests = landings & holes & (pegs << step) & (pegs << (2 * step))
+            else:
+                dests = landings & holes & (pegs >> -step) & (pegs >> (-2 * step))
+            found.append((dests, by_dest))
+            landed |= dests
+
+        # List the moves hole by hole like PegSolitaire does; the search order
+        # (and so the solve time) depends on it
+        moves = []
+        while landed:
+            low = landed & -landed
+            landed ^= low
+            dest = low.bit_length() - 1
+            for dests, by_dest in found:
+                if dests & low:
+                    moves.append(by_dest[dest])
+
+        return moves
+
+########################################################################################
+
+    def pegs_remaining(self) -> int:
+        """ Returns the total amount of remaining pegs """
+        return self.count
+
+
+########################################################################################
+########################################################################################
+########################################################################################
+
+def parse_frozen_set(line: str) -> BoardSet:
+    """ The size, peg, out and linked atoms of a line holding a clyngor frozenset,
+        as a frozenset PegSolitaire can build the board from. The line is matched
+        with BOARD_ATOM rather than evaluated, so nothing in it is run and no
+        tuples are built for the other atoms
+    """
+    atoms = frozenset(
+        (name, (int(x), int(y))) for name, x, y in BOARD_ATOM.findall(line)
+    )
+    if not any(name == "size" for name, _ in atoms):
+        raise ValueError("No size atom in board line: {:.60}".format(line))
+    return atoms
+
+
+def iter_board_lines(input_file: str) -> Iterator[Tuple[str, BoardSet]]:
+    """ Yields (line, parse_frozen_set(line)) for every board line of a file,
+        reading one line at a time. _solvable.txt files follow each board with a
+        blank line and its solve times, which are skipped
+    """
     with open(input_file) as f:
-        lines = f.readlines()  # Grab every other line from start to EOF
+        for line in f:
+            if line.startswith("frozenset"):
+                yield line.rstrip("\n"), parse_frozen_set(line)
+
+
+def iter_frozen_sets(input_file: str) -> Iterator[BoardSet]:
+    """ The boards of a file of frozensets, parsed lazily one line at a time """
+    for _, board in iter_board_lines(input_file):
+        yield board
+
+
+def process_frozen_sets(input_file: str) -> List[BoardSet]:
+    return list(iter_frozen_sets(input_file))
+
+
+def board_offsets(input_file: str) -> "array.array":
+    """ The byte offset of every board line of a file of frozensets, from its
+        index file (input_file + BOARD_INDEX_SUFFIX). The index is built the
+        first time and again whenever the file's size or modification time no
+        longer match it. In a _solvable.txt file each offset starts a record of
+        the board line, a blank line and the solve times
+    """
+    stat = os.stat(input_file)
+    index = input_file + BOARD_INDEX_SUFFIX
+    offsets = array.array("Q")
+    try:
+        with open(index, "rb") as f:
+            header = f.read(BOARD_INDEX_HEADER.size)
+            magic, size, mtime, count = BOARD_INDEX_HEADER.unpack(header)
+            current = (BOARD_INDEX_MAGIC, stat.st_size, stat.st_mtime_ns)
+            if (magic, size, mtime) == current:
+                offsets.fromfile(f, count)
+                return offsets
+    except (OSError, EOFError, struct.error):
+        pass
+
+    offsets = array.array("Q")
+    offset = 0
+    with open(input_file, "rb") as f:
+        for line in f:
+            if line.startswith(b"frozenset"):
+                offsets.append(offset)
+            offset += len(line)
+
+    # A file in a read-only directory just goes without an index
+    try:
+        with open(index, "wb") as f:
+            f.write(BOARD_INDEX_HEADER.pack(
+                BOARD_INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, len(offsets)
+            ))
+            offsets.tofile(f)
+    except OSError:
+        pass
+    return offsets
+
+
+def read_board_lines(input_file: str, start: int = 0,
+                     stop: int = None) -> Iterator[Tuple[str, BoardSet]]:
+    """ Yields (line, parse_frozen_set(line)) for boards start to stop (as in a
+        slice) of a file of frozensets, seeking to each through board_offsets
+        instead of reading the boards before them
+    """
+    offsets = board_offsets(input_file)
+    with open(input_file, "rb") as f:
+        for offset in offsets[start:stop]:
+            f.seek(offset)
+            line = f.readline().decode().rstrip("\n")
+            yield line, parse_frozen_set(line)
 
-        # Go through each string and convert it to a frozenset
-        for line in lines:
-            boards.append(eval(line))
 
-    return boards
+########################################################################################
 
+def peg_priority(board: BitBoard) -> int:
+    """ The default A* priority: boards with fewer pegs left are expanded first """
+    return board.count
+
+
+def peg_and_move_priority(board: BitBoard) -> int:
+    """ Fewer pegs and fewer available moves first (the old commented-out variant
+        of PegSolitaire.__lt__)
+    """
+    return board.count + len(board.total_moves())
 
 ########################################################################################
 
-def a_star_solve(board: PegSolitaire) -> bool:
-    board_queue = PriorityQueue()
-    board_set = set()
+class CancelToken:
+    """ A flag that stops every search whose Budget holds it, set from another
+        thread (such as the GUI's) or process. A shared token can be handed to
+        worker processes when they are started, as batch_solve does
+    """
+
+    def __init__(self, shared: bool = False):
+        self.event = multiprocessing.Event() if shared else threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+
+class Budget:
+    """ Limits on a search: wall seconds (BOARD_SOLVE_TIME unless given), CPU
+        seconds, nodes expanded, and positions held in its visited set or tables
+        at once, plus an optional CancelToken. A limit left as None doesn't apply.
+        Searches check their budget every BUDGET_CHECK_INTERVAL nodes rather than
+        on each, so they may run a little past a limit.
+
+        Every engine takes one as budget. Each search restarts the counts, and
+        afterwards stats (also on the SolveResult the engine returns) holds how
+        far it got, with stopped naming the limit that ended it ("time", "cpu",
+        "nodes", "visited" or "cancelled"), or None if it finished
+    """
+
+    def __init__(self, seconds: float = None, cpu_seconds: float = None,
+                 nodes: int = None, visited: int = None, token: CancelToken = None):
+        self.seconds = seconds
+        self.cpu_seconds = cpu_seconds
+        self.max_nodes = nodes
+        self.max_visited = visited
+        self.token = token
+        self.start()
+
+    def start(self):
+        self.started = time.time()
+        self.cpu_started = time.process_time()
+        self.nodes = 0
+        self.peak_visited = 0
+        self.stopped = None
+        self.elapsed = self.cpu_elapsed = 0.0
+
+    def tick(self, visited: int = 0) -> bool:
+        """ Counts one node, and every BUDGET_CHECK_INTERVAL nodes checks the
+            budget. Returns whether the search has to stop
+        """
+        self.nodes += 1
+        return self.nodes % BUDGET_CHECK_INTERVAL == 0 and self.spent(visited)
 
-    board_queue.put(board)
+    def spent(self, visited: int = 0) -> bool:
+        """ Whether the search is over budget, given how many positions it holds
+            now. The limit it went over is kept in stopped
+        """
+        self.peak_visited = max(self.peak_visited, visited)
+        seconds = BOARD_SOLVE_TIME if self.seconds is None else self.seconds
+        if self.token is not None and self.token.cancelled:
+            self.stopped = "cancelled"
+        elif time.time() - self.started >= seconds:
+            self.stopped = "time"
+        elif (self.cpu_seconds is not None
+              and time.process_time() - self.cpu_started >= self.cpu_seconds):
+            self.stopped = "cpu"
+        elif self.max_nodes is not None and self.nodes >= self.max_nodes:
+            self.stopped = "nodes"
+        elif self.max_visited is not None and self.peak_visited >= self.max_visited:
+            self.stopped = "visited"
+        return self.stopped is not None
+
+    def finish(self):
+        """ Freezes the time spent, once the search is over """
+        self.elapsed = time.time() - self.started
+        self.cpu_elapsed = time.process_time() - self.cpu_started
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "nodes": self.nodes,
+            "peak_visited": self.peak_visited,
+            "seconds": self.elapsed,
+            "cpu_seconds": self.cpu_elapsed,
+            "stopped": self.stopped,
+        }
+
+
+class SearchStats:
+    """ Counters of one search, filled in by an engine given one as stats:
+        positions expanded (their moves generated) and children generated,
+        children dropped as duplicates of positions already seen or cut by a
+        pagoda function or dead-position detector (with the cuts of each by
+        name, the start position included), the largest frontier and visited
+        set, expansions and children per peg count (the branching factor of each
+        layer), and the seconds spent generating moves, on the frontier, and on
+        everything else.
+
+        Engines skip all of it when stats is None, so it costs next to nothing
+        unless asked for
+    """
+
+    def __init__(self):
+        self.expanded = 0
+        self.generated = 0
+        self.duplicates = 0
+        self.pruned = 0
+        self.cuts = {}
+        self.peak_frontier = 0
+        self.peak_visited = 0
+        self.layers = {}
+        self.seconds = {"movegen": 0.0, "queue": 0.0, "other": 0.0}
+        self._clock = time.perf_counter()
+
+    def expand(self, pegs: int, children: int, frontier: int, visited: int,
+               count: int = 1):
+        """ Counts count positions with pegs pegs being expanded into children
+            children, with the frontier and visited set at the given sizes
+        """
+        self.expanded += count
+        self.generated += children
+        layer = self.layers.get(pegs)
+        if layer is None:
+            layer = self.layers[pegs] = [0, 0]
+        layer[0] += count
+        layer[1] += children
+        self.peak_frontier = max(self.peak_frontier, frontier)
+        self.peak_visited = max(self.peak_visited, visited)
+
+    def lap(self, part: str):
+        """ Adds the time since the last lap to part of self.seconds """
+        now = time.perf_counter()
+        self.seconds[part] += now - self._clock
+        self._clock = now
+
+    def as_dict(self) -> dict:
+        return {
+            "expanded": self.expanded,
+            "generated": self.generated,
+            "duplicates": self.duplicates,
+            "pruned": self.pruned,
+            "cuts": dict(self.cuts),
+            "peak_frontier": self.peak_frontier,
+            "peak_visited": self.peak_visited,
+            "branching": {
+                pegs: generated / expanded
+                for pegs, (expanded, generated) in sorted(
+                    self.layers.items(), reverse=True
+                )
+            },
+            "seconds": dict(self.seconds),
+        }
 
-    start = time.time()
 
-    # While the queue is not empty
-    while not board_queue.empty():
-        end = time.time()
+class SolveResult:
+    """ What an engine returns: solved, whether the board can be solved, and the
+        stats of its budget (see Budget.stats), which say how far the search got
+        even when no Budget was passed in. It is true only if the board was
+        solved, so an engine's answer can be tested like a bool; stopped names
+        the limit that ended the search, in which case solved is False because
+        the search couldn't tell
+    """
+
+    def __init__(self, solved: bool, stats: dict):
+        self.solved = solved
+        self.stats = stats
+
+    def __bool__(self) -> bool:
+        return self.solved
+
+    @property
+    def stopped(self) -> str:
+        return self.stats["stopped"]
 
-        # Move on to the next board if it takes too long to solve this puzzle
-        if end - start >= BOARD_SOLVE_TIME:
-            # print(".", end="")
-            # sys.stdout.flush()
+    def __repr__(self) -> str:
+        return "SolveResult({!r}, {!r})".format(self.solved, self.stats)
+
+########################################################################################
+
+def a_star_solve(board: PegSolitaire, priority=peg_priority, results: dict = None,
+                 pruned: dict = None, path: list = None, budget: Budget = None,
+                 stats: SearchStats = None, pagoda_limit: int = None,
+                 detectors=None) -> SolveResult:
+    """ Best-first search for a sequence of jumps that leaves a single peg.
+
+        priority is called on each new BitBoard and boards with the lowest value are
+        expanded first; ties go to the board that was pushed first.
+
+        results, if given, maps (BoardShape, canonical peg mask) of start positions to
+        whether they were solvable. A start position already in it is answered
+        without searching, and finished searches are added to it, so a board and
+        its mirror images or rotations are only ever solved once.
+
+        Every new board is checked against the pagoda_limit pagoda functions
+        picked by BoardShape.pagoda_checks and the dead-position detectors named
+        in detectors before it is queued (PAGODA_LIMIT and DEAD_DETECTORS if not
+        given). If pruned is given, the number of boards each function or
+        detector cut off is added to it by name.
+
+        If path is given and the board can be solved, the jumps of a solution are
+        appended to it as (x1, y1, x2, y2) moves, ready for perform_move.
+
+        budget limits the search (a Budget of BOARD_SOLVE_TIME seconds if not
+        given) and holds its stats afterwards. If stats is given, the SearchStats
+        of the search are counted in it. Every engine takes path, budget, stats,
+        pagoda_limit and detectors the same way, and returns a SolveResult with
+        the budget's stats.
+    """
+    return _solve(board, results,
+                  lambda start, budget: _a_star_search(
+                      start, priority, pruned, path, budget, stats, pagoda_limit,
+                      detectors,
+                  ),
+                  path, budget)
+
+
+def _solve(board: PegSolitaire, results: dict, search, path: list = None,
+           budget: Budget = None) -> SolveResult:
+    """ Runs search(board, budget) on board (as a BitBoard), going through the
+        results table the way a_star_solve describes. search returns None if it
+        went over budget. path is the list the search appends its solution to, if
+        one was asked for
+    """
+    # Search over compact BitBoards; a PegSolitaire is converted once up front
+    board = BitBoard.from_board(board)
+    key = _results_key(board)
+    budget = Budget() if budget is None else budget
+    budget.start()
+
+    # A result from the table has no moves with it, so a solvable board is
+    # searched again when its solution is wanted. Boards in the wrong position
+    # class can be ruled out without searching, and boards with a solvability
+    # database are looked up instead
+    if (results is not None and key in results
+            and not (results[key] and path is not None)):
+        solved = results[key]
+    elif not bialostocki_solver(board):
+        solved = False
+    elif board.shape in _DATABASES:
+        solved = _DATABASES[board.shape].solvable(board)
+        if solved and path is not None:
+            path.extend(_DATABASES[board.shape].solution(board))
+    else:
+        solved = search(board, budget)
+    budget.finish()
+    if results is not None and solved is not None:
+        results[key] = solved
+    return SolveResult(bool(solved), budget.stats)
+
+
+class _PagodaChecks:
+    """ The pagoda functions one search checks new positions against, with each
+        move's effect on all of them precomputed so a child's values are a few
+        additions away from its parent's, and the dead-position detectors it runs
+    """
+
+    def __init__(self, board: BitBoard, pruned: dict, limit: int = None,
+                 detectors=None, stats: "SearchStats" = None):
+        self.shape = board.shape
+        self.detectors = DEAD_DETECTORS if detectors is None else detectors
+        picked = board.shape.pagoda_checks(board.pegs, limit)
+        self.pagodas = [pagoda for pagoda, _ in picked]
+        self.thresholds = [threshold for _, threshold in picked]
+        self.deltas = {
+            source + dest: [pagoda.deltas[source + dest] for pagoda in self.pagodas]
+            for source, over, dest in board.shape.moves
+        }
+        # The pruned dict and the cuts of stats, whichever were given
+        self.tallies = [
+            tally for tally in (pruned, stats.cuts if stats is not None else None)
+            if tally is not None
+        ]
+        for tally in self.tallies:
+            for name in [pagoda.name for pagoda in self.pagodas] + list(self.detectors):
+                tally.setdefault(name, 0)
+
+    def count(self, name: str, positions: int = 1):
+        """ Counts positions ruled out by the function or detector called name """
+        for tally in self.tallies:
+            tally[name] += positions
+
+    def values(self, pegs: int) -> List[int]:
+        return [pagoda.value(pegs) for pagoda in self.pagodas]
+
+    def after(self, values: List[int], move) -> List[int]:
+        """ The values after making move from a position with these values """
+        return list(map(operator.add, values, self.deltas[move]))
+
+    def cut(self, values: List[int]) -> bool:
+        """ Whether a position's values rule it out, counting the function that did
+            it in pruned and stats
+        """
+        if not any(map(operator.lt, values, self.thresholds)):
             return False
+        if self.tallies:
+            for pagoda, threshold, value in zip(self.pagodas, self.thresholds, values):
+                if value < threshold:
+                    self.count(pagoda.name)
+                    break
+        return True
+
+    def dead(self, pegs: int) -> bool:
+        """ Whether a dead-position detector rules a position out, counting the
+            one that did it in pruned and stats
+        """
+        name = self.shape.dead_detector(pegs, self.detectors)
+        if name is None:
+            return False
+        self.count(name)
+        return True
+
+
+def _results_key(board: BitBoard):
+    """ The key of a start position in a results table """
+    return (board.shape, board.shape.canonical(board.pegs))
+
+
+def _a_star_search(board: BitBoard, priority, pruned: dict = None,
+                   solution: list = None, budget: Budget = None,
+                   stats: SearchStats = None, pagoda_limit: int = None,
+                   detectors=None) -> bool:
+    """ The search loop of a_star_solve. Returns None if it went over budget. If
+        solution is given, the moves to the solved position are appended to it
+    """
+    budget = Budget() if budget is None else budget
+    shape = board.shape
+    checks = _PagodaChecks(board, pruned, pagoda_limit, detectors, stats)
+    values = checks.values(board.pegs)
+    if checks.cut(values):
+        return False
+
+    # The frontier is a plain heap of (priority, tiebreak, peg mask) entries, so the
+    # heap never has to compare boards. A board is marked as seen when it is pushed,
+    # so each position sits in the frontier at most once. Positions are stored in
+    # their canonical form, so mirror images and rotations count as seen too
+    board_queue = [(priority(board), 0, board.pegs)]
+    board_set = {shape.canonical(board.pegs)}
+    pushed = 1
+
+    # When a solution is wanted, the move that led to each queued board is kept
+    # by its peg mask. The board before it is the mask with the move flipped back,
+    # so no board has to be stored twice
+    parents = {} if solution is not None else None
+
+    # While the queue is not empty
+    while board_queue:
+        # Move on to the next board if this one takes too long (or too much)
+        if budget.tick(len(board_set)):
+            return None
 
         # Get a board and all its available moves.
-        curr_board = board_queue.get()
+        if stats is not None:
+            stats.lap("other")
+        curr_board = BitBoard(shape, heapq.heappop(board_queue)[2])
+        if stats is not None:
+            stats.lap("queue")
         moves = curr_board.total_moves()
-
-        # Keep track of which boards you've seen
-        board_set.add(curr_board)
+        if stats is not None:
+            stats.lap("movegen")
+            stats.expand(curr_board.count, len(moves), len(board_queue) + 1,
+                         len(board_set))
+        images = shape.images(curr_board.pegs)
+        values = checks.values(curr_board.pegs)
 
         # If there are no more moves, you might have found a successfull puzzle!
         if len(moves) == 0:
             # Congrats! You found a board that can be solved!
             if curr_board.pegs_remaining() == 1:
-                # print("!", end="")
-                # sys.stdout.flush()
+                if solution is not None:
+                    solution.extend(
+                        _parent_moves(shape, parents, board.pegs, curr_board.pegs)
+                    )
                 return True
             continue
 
-        # Do every possible move, and add each new board back into the PriorityQueue
+        # Do every possible move, and add each new board to the heap. The first
+        # image of a move is the move itself, so the new board's mask and its
+        # canonical form both come from XORing the move into the current images
         for move in moves:
-            temp = curr_board.copy()
-            temp.perform_move(*move)
+            flipped = shape.move_images[move]
+            if len(images) == 1:
+                seen_as = images[0] ^ flipped[0]
+            else:
+                seen_as = min(map(operator.xor, images, flipped))
 
             # Only add a board to the queue if you've never seen it before
-            if temp not in board_set:
-                board_queue.put(temp)
+            if seen_as not in board_set:
+                board_set.add(seen_as)
+
+                # Don't queue boards a pagoda function or dead-position detector
+                # proves can't be solved
+                if (checks.cut(checks.after(values, move))
+                        or checks.dead(curr_board.pegs ^ flipped[0])):
+                    if stats is not None:
+                        stats.pruned += 1
+                    continue
+
+                temp = BitBoard(shape, curr_board.pegs ^ flipped[0],
+                                curr_board.count - 1)
+                if stats is not None:
+                    stats.lap("other")
+                heapq.heappush(board_queue, (priority(temp), pushed, temp.pegs))
+                if stats is not None:
+                    stats.lap("queue")
+                pushed += 1
+                if parents is not None:
+                    parents[temp.pegs] = move
+            elif stats is not None:
+                stats.duplicates += 1
+
+    return False
+
+
+def _parent_moves(shape: BoardShape, parents: dict, start: int, pegs: int) -> list:
+    """ The moves from start to pegs, following the moves parents keeps by the peg
+        mask they led to
+    """
+    moves = []
+    while pegs != start:
+        move = parents[pegs]
+        moves.append(move)
+        pegs ^= shape.move_images[move][0]
+    return moves[::-1]
+
+########################################################################################
+
+def dfs_solve(board: PegSolitaire, dead_limit: int = DEAD_CACHE_SIZE,
+              results: dict = None, pruned: dict = None, path: list = None,
+              budget: Budget = None, stats: SearchStats = None,
+              pagoda_limit: int = None, detectors=None) -> SolveResult:
+    """ Depth-first search for a sequence of jumps that leaves a single peg.
+
+        Every jump removes one peg, so every line of play ends at the same depth
+        and there is no frontier to keep around: one board is searched in place
+        with perform_move/undo_move. Positions proven unsolvable are remembered in
+        a table of at most dead_limit canonical peg masks, dropping the least
+        recently used one when it is full. results, pruned, pagoda_limit and
+        detectors work as in a_star_solve, with the pagoda functions and
+        detectors checked on each new position.
+    """
+    return _solve(board, results,
+                  lambda start, budget: _dfs_search(
+                      start, dead_limit, pruned, None, path, budget, stats,
+                      pagoda_limit, detectors,
+                  ),
+                  path, budget)
+
+
+def _dfs_search(board: BitBoard, dead_limit: int, pruned: dict = None,
+                meet: tuple = None, solution: list = None, budget: Budget = None,
+                stats: SearchStats = None, pagoda_limit: int = None,
+                detectors=None) -> bool:
+    """ The search loop of dfs_solve. Returns None if it went over budget.
+
+        meet is an optional (peg count, layer) pair from bidirectional_solve: a
+        position with that many pegs is solved if its canonical mask is in the
+        layer, and dead if not. If solution is given, the moves to a solved
+        position are appended to it
+    """
+    shape = board.shape
+    if meet is not None and board.count == meet[0]:
+        return shape.canonical(board.pegs) in meet[1]
+    moves = board.total_moves()
+    if stats is not None:
+        stats.expand(board.count, len(moves), 1, 0)
+    if len(moves) == 0:
+        return board.pegs_remaining() == 1
+
+    checks = _PagodaChecks(board, pruned, pagoda_limit, detectors, stats)
+    values = checks.values(board.pegs)
+    if checks.cut(values):
+        return False
+
+    dead = OrderedDict()
+    budget = Budget() if budget is None else budget
+
+    # One iterator of untried moves and the pagoda values per level of the current
+    # line of play, and the moves made to get there
+    stack = [iter(moves)]
+    levels = [values]
+    path = []
+    while stack:
+        move = next(stack[-1], None)
+
+        # Every move from this position has been tried, so it is a dead end
+        if move is None:
+            stack.pop()
+            levels.pop()
+            if path:
+                _remember_dead(dead, shape.canonical(board.pegs), dead_limit)
+                board.undo_move(*path.pop())
+            continue
+
+        if budget.tick(len(dead)):
+            return None
+
+        after = checks.after(levels[-1], move)
+        if checks.cut(after):
+            if stats is not None:
+                stats.pruned += 1
+            continue
+
+        board.perform_move(*move)
+        key = shape.canonical(board.pegs)
+        if meet is not None and board.count == meet[0]:
+            if key in meet[1]:
+                if solution is not None:
+                    solution.extend(path + [move])
+                return True
+            board.undo_move(*move)
+            continue
+        if key in dead:
+            dead.move_to_end(key)
+            board.undo_move(*move)
+            if stats is not None:
+                stats.duplicates += 1
+            continue
+        if checks.dead(board.pegs):
+            board.undo_move(*move)
+            if stats is not None:
+                stats.pruned += 1
+            continue
+
+        if stats is not None:
+            stats.lap("other")
+        moves = board.total_moves()
+        if stats is not None:
+            stats.lap("movegen")
+            stats.expand(board.count, len(moves), len(stack) + 1, len(dead))
+        if len(moves) == 0:
+            # Congrats! You found a board that can be solved!
+            if board.pegs_remaining() == 1:
+                if solution is not None:
+                    solution.extend(path + [move])
+                return True
+            _remember_dead(dead, key, dead_limit)
+            board.undo_move(*move)
+            continue
+
+        path.append(move)
+        stack.append(iter(moves))
+        levels.append(after)
 
     return False
 
+
+def _remember_dead(dead: OrderedDict, key: int, dead_limit: int):
+    """ Adds a position to the dead-position table, evicting the least recently
+        used one if the table is full
+    """
+    dead[key] = True
+    if len(dead) > dead_limit:
+        dead.popitem(last=False)
+
+########################################################################################
+
+def bidirectional_solve(board: PegSolitaire, meet_size: int = MEET_LAYER_SIZE,
+                        results: dict = None, pruned: dict = None,
+                        path: list = None, budget: Budget = None,
+                        stats: SearchStats = None, pagoda_limit: int = None,
+                        detectors=None) -> SolveResult:
+    """ Searches backward from every position with one peg left on a cell the last
+        peg could end up on (BoardShape.final_cells), undoing jumps a layer at a
+        time until a layer holds at least meet_size positions or has as many pegs
+        as the board. Then searches forward from the board like dfs_solve down to
+        that layer's peg count, where every position either is in the layer and
+        so can be solved, or isn't and so can't. This cuts the bottom levels off
+        the forward search, which is where most of its positions are.
+
+        results, pruned, path, budget, stats, pagoda_limit and detectors work as
+        in a_star_solve, the pruning only checking the forward search; the
+        backward layers count towards stats by the pegs of the positions undone.
+    """
+    return _solve(board, results,
+                  lambda start, budget: _bidirectional_search(
+                      start, meet_size, pruned, path, budget, stats, pagoda_limit,
+                      detectors),
+                  path, budget)
+
+
+def _bidirectional_search(board: BitBoard, meet_size: int, pruned: dict = None,
+                          path: list = None, budget: Budget = None,
+                          stats: SearchStats = None, pagoda_limit: int = None,
+                          detectors=None) -> bool:
+    """ The search of bidirectional_solve. Returns None if it went over budget """
+    shape = board.shape
+    budget = Budget() if budget is None else budget
+
+    # Each layer maps canonical peg masks to (peg mask, peg mask after the move,
+    # move)
+    backward = [{
+        shape.canonical(1 << cell): (1 << cell, None, None)
+        for cell in shape.final_cells(board.pegs)
+    }]
+    while len(backward[-1]) < meet_size and len(backward) < board.count:
+        backward.append(
+            _backward_layer(shape, backward[-1], len(backward), budget, stats)
+        )
+        if backward[-1] is None:
+            return None
+        if not backward[-1]:
+            return False
+
+    forward = []
+    solved = _dfs_search(board.copy(), DEAD_CACHE_SIZE, pruned,
+                         (len(backward), backward[-1]), forward, budget, stats,
+                         pagoda_limit, detectors)
+    if solved and path is not None:
+        for move in forward:
+            board.perform_move(*move)
+        path.extend(forward)
+        path.extend(_backward_path(shape, backward, board.pegs))
+    return solved
+
+
+def _backward_layer(shape: BoardShape, layer: dict, pegs_left: int, budget: Budget,
+                    stats: SearchStats = None) -> dict:
+    """ Every position one jump before a position in a bidirectional_solve layer.
+        Returns None if the search went over budget
+    """
+    before = {}
+    for pegs, _, _ in layer.values():
+        if budget.tick(len(before)):
+            return None
+        images = shape.images(pegs)
+        moves = BitBoard(shape, pegs, pegs_left).reverse_moves()
+        if stats is not None:
+            stats.expand(pegs_left, len(moves), len(layer), len(before))
+        for move in moves:
+            flipped = shape.move_images[move]
+            key = min(map(operator.xor, images, flipped))
+            if key not in before:
+                before[key] = (pegs ^ flipped[0], pegs, move)
+            elif stats is not None:
+                stats.duplicates += 1
+    return before
+
+
+def _backward_path(shape: BoardShape, backward: List[dict], pegs: int) -> list:
+    """ The moves from the position pegs, found in the last backward layer, down to
+        a single peg. The layers may hold mirror images or rotations of the
+        positions along the way, in which case their moves are turned to match
+    """
+    moves = []
+    for layer in reversed(backward[1:]):
+        stored, _, move = layer[shape.canonical(pegs)]
+        move = _turn_moves(shape.turn(stored, pegs), [move])[0]
+        moves.append(move)
+        pegs ^= shape.move_images[move][0]
+    return moves
+
+
+def _turn_moves(cells: dict, moves: list) -> list:
+    """ Moves mapped through the (x, y) map of a symmetry """
+    return [cells[tuple(move[:2])] + cells[tuple(move[2:])] for move in moves]
+
+########################################################################################
+
+def layered_solve(board: PegSolitaire, results: dict = None, pruned: dict = None,
+                  path: list = None, budget: Budget = None,
+                  stats: SearchStats = None, pagoda_limit: int = None,
+                  detectors=None) -> SolveResult:
+    """ Breadth-first search a layer at a time. Every jump removes one peg, so the
+        positions reachable from the board split into layers by peg count and each
+        layer follows from the one before it alone. The board is solvable if the
+        layer with one peg left isn't empty. Only two layers are kept at once.
+
+        With NumPy, a layer is an array of uint64 peg masks and each move is
+        applied to the whole layer at once; duplicates under the shape's
+        symmetries are dropped with np.unique. Without NumPy, or on boards of
+        more than 64 cells, layers are dicts of Python ints instead.
+
+        results, pruned, path, budget, stats, pagoda_limit and detectors work as
+        in a_star_solve, with the nodes of a budget counting expanded positions
+        and its visited size (and the frontier of stats) the largest layer. To
+        trace a solution back, the canonical masks of every layer are kept while
+        path is given.
+    """
+    return _solve(board, results,
+                  lambda start, budget: _layered_search(
+                      start, pruned, path, budget, stats, pagoda_limit, detectors
+                  ),
+                  path, budget)
+
+
+def _layered_search(board: BitBoard, pruned: dict = None, solution: list = None,
+                    budget: Budget = None, stats: SearchStats = None,
+                    pagoda_limit: int = None, detectors=None) -> bool:
+    """ The search of layered_solve. Returns None if it went over budget. If
+        solution is given, the moves to a single peg are appended to it
+    """
+    budget = Budget() if budget is None else budget
+    shape = board.shape
+    checks = _PagodaChecks(board, pruned, pagoda_limit, detectors, stats)
+    if checks.cut(checks.values(board.pegs)):
+        return False
+
+    if np is not None and shape.rows * shape.cols <= 64:
+        arrays = _LayerArrays(shape, checks)
+        expand = lambda layer, pegs_left: arrays.expand(layer, budget, stats, pegs_left)
+        keys = arrays.keys
+        layer = np.array([board.pegs], dtype=np.uint64)
+    else:
+        expand = lambda layer, pegs_left: _expand_layer(
+            shape, layer, checks, budget, stats, pegs_left
+        )
+        keys = lambda layer: layer
+        layer = {shape.canonical(board.pegs): board.pegs}
+
+    # The canonical masks of each layer so far, if a solution has to be traced
+    history = []
+    for pegs_left in range(board.count, 1, -1):
+        if solution is not None:
+            history.append(keys(layer))
+        layer = expand(layer, pegs_left)
+        if layer is None or budget.spent(len(layer)):
+            return None
+        if len(layer) == 0:
+            return False
+
+    if solution is not None:
+        last = next(iter(layer.values())) if isinstance(layer, dict) else int(layer[0])
+        solution.extend(_trace_layers(shape, board.pegs, history, last))
+    return True
+
+
+def _trace_layers(shape: BoardShape, start: int, history: list, pegs: int) -> list:
+    """ The moves from start to the position pegs, found by undoing one jump at a
+        time into a position of each earlier layer in history. The positions found
+        that way are turned relative to the layers' own, so the moves end up
+        turned to match start at the end
+    """
+    moves = []
+    for keys in reversed(history):
+        for move in BitBoard(shape, pegs).reverse_moves():
+            before = pegs ^ shape.move_images[move][0]
+            if _layer_has(keys, shape.canonical(before)):
+                break
+        moves.append(move)
+        pegs = before
+    return _turn_moves(shape.turn(pegs, start), moves[::-1])
+
+
+def _layer_has(keys, key: int) -> bool:
+    """ Whether a canonical mask is among a layer's keys: a dict without NumPy, or a
+        sorted array with it
+    """
+    if isinstance(keys, dict):
+        return key in keys
+    i = np.searchsorted(keys, np.uint64(key))
+    return i < len(keys) and keys[i] == key
+
+
+def _expand_layer(shape: BoardShape, layer: dict, checks: _PagodaChecks,
+                  budget: Budget = None, stats: SearchStats = None,
+                  pegs_left: int = 0) -> dict:
+    """ The next layer of layered_solve without NumPy. Layers map canonical peg
+        masks to the actual position first found with that mask, since the
+        pagoda thresholds only hold for the board's own orientation. Returns
+        None if the search went over budget
+    """
+    following = {}
+    for pegs in layer.values():
+        if budget is not None and budget.tick(len(following)):
+            return None
+
+        images = shape.images(pegs)
+        values = checks.values(pegs)
+        moves = BitBoard(shape, pegs, pegs_left).total_moves()
+        if stats is not None:
+            stats.expand(pegs_left, len(moves), len(layer), len(layer) + len(following))
+        for move in moves:
+            flipped = shape.move_images[move]
+            key = min(map(operator.xor, images, flipped))
+            if key in following:
+                if stats is not None:
+                    stats.duplicates += 1
+            elif checks.cut(checks.after(values, move)):
+                if stats is not None:
+                    stats.pruned += 1
+            else:
+                following[key] = pegs ^ flipped[0]
+    return following
+
+
+def _sorted_unique(values):
+    """ np.unique for uint64 masks. Newer NumPy versions hash them instead, which is
+        far slower than sorting on masks like these
+    """
+    values = np.sort(values)
+    keep = np.ones(len(values), dtype=bool)
+    keep[1:] = values[1:] != values[:-1]
+    return values[keep]
+
+
+class _LayerArrays:
+    """ The move masks, symmetry tables and pagoda tables of a shape as NumPy arrays,
+        for expanding whole layers of uint64 peg masks at once
+    """
+
+    def __init__(self, shape: BoardShape, checks: _PagodaChecks):
+        self.checks = checks
+        self.bits = np.uint64(shape.chunk_bits)
+        self.mask = np.uint64((1 << shape.chunk_bits) - 1)
+
+        # A move can be made when its source and middle cells have pegs and its
+        # landing cell doesn't, and is made by flipping all three
+        self.moves = []
+        for source, over, dest in shape.moves:
+            flip = shape.move_images[source + dest][0]
+            self.moves.append((np.uint64(flip), np.uint64(flip ^ shape.bit(*dest))))
+
+        self.symmetries = [
+            [np.array(table, dtype=np.uint64) for table in tables]
+            for tables in shape.symmetries[1:]
+        ]
+        self.pagodas = [
+            [
+                np.array(table, dtype=np.int64)
+                for table in shape.chunk_tables(pagoda.weights, operator.add)
+            ]
+            for pagoda in checks.pagodas
+        ]
+
+    def _chunks(self, layer):
+        """ The four chunks of bits of each mask, as lookup table indices """
+        bits, mask = self.bits, self.mask
+        return [
+            ((layer >> (bits * np.uint64(n))) & mask).astype(np.intp)
+            for n in range(4)
+        ]
+
+    def expand(self, layer, budget: Budget = None, stats: SearchStats = None,
+               pegs_left: int = 0):
+        """ The next layer: every position one jump after one in this layer that
+            survives the pagoda checks, one per class of symmetric positions.
+            Returns None if the search went over budget. A chunk of the layer is
+            counted in stats at a time, with pegs_left the pegs of this layer
+        """
+        # A shape too small for any jump has nothing to concatenate
+        if not self.moves:
+            return layer[:0]
+        found = []
+        for first in range(0, len(layer), LAYER_CHUNK_SIZE):
+            part = layer[first:first + LAYER_CHUNK_SIZE]
+            if budget is not None:
+                budget.nodes += len(part)
+                if budget.spent(len(layer) + sum(map(len, found))):
+                    return None
+            if stats is not None:
+                stats.lap("other")
+            children = np.concatenate([
+                part[(part & flip) == need] ^ flip for flip, need in self.moves
+            ])
+            survivors = self._survivors(children)
+            if stats is not None:
+                stats.lap("movegen")
+            found.append(self._unique(survivors))
+            if stats is not None:
+                stats.lap("queue")
+                stats.pruned += len(children) - len(survivors)
+                stats.duplicates += len(survivors) - len(found[-1])
+                stats.expand(pegs_left, len(children), len(layer),
+                             len(layer) + sum(map(len, found)), len(part))
+        if not found:
+            return layer[:0]
+        following = self._unique(np.concatenate(found))
+        if stats is not None:
+            stats.lap("queue")
+            stats.duplicates += sum(map(len, found)) - len(following)
+        return following
+
+    def _canonical(self, layer):
+        """ The canonical mask of each position of a layer """
+        if not self.symmetries or len(layer) == 0:
+            return layer
+        chunks = self._chunks(layer)
+        keys = layer
+        for tables in self.symmetries:
+            image = (tables[0][chunks[0]] | tables[1][chunks[1]]
+                     | tables[2][chunks[2]] | tables[3][chunks[3]])
+            keys = np.minimum(keys, image)
+        return keys
+
+    def keys(self, layer):
+        """ The canonical masks of a layer, sorted """
+        return np.sort(self._canonical(layer))
+
+    def _unique(self, layer):
+        """ The positions of a layer with duplicates under the symmetries dropped,
+            keeping each one's own orientation
+        """
+        if not self.symmetries or len(layer) == 0:
+            return _sorted_unique(layer)
+        _, first = np.unique(self._canonical(layer), return_index=True)
+        return layer[first]
+
+    def _survivors(self, layer):
+        """ The positions of a layer whose pagoda values are all at or above their
+            thresholds, counting the ones cut by each function in the checks
+        """
+        if not self.pagodas or len(layer) == 0:
+            return layer
+        chunks = self._chunks(layer)
+        keep = np.ones(len(layer), dtype=bool)
+        checked = zip(self.checks.pagodas, self.pagodas, self.checks.thresholds)
+        for pagoda, tables, threshold in checked:
+            value = (tables[0][chunks[0]] + tables[1][chunks[1]]
+                     + tables[2][chunks[2]] + tables[3][chunks[3]])
+            cut = keep & (value < threshold)
+            if self.checks.tallies:
+                self.checks.count(pagoda.name, int(cut.sum()))
+            keep &= ~cut
+        return layer[keep]
+
+########################################################################################
+
+def count_lines(board: PegSolitaire) -> dict:
+    """ Counts the lines of play from board, as features of how hard it is to
+        solve. Every position reachable from the board is visited once, without
+        pagoda pruning, one peg-count layer at a time as in layered_solve, with
+        mirror images and rotations counted as one position. Working back from
+        the last layer, each position's number of lines is the sum over its
+        children, so no line is ever played out on its own.
+
+        Returns a dict of:
+            pegs: pegs on the board
+            winning_lines, total_lines: move sequences from the board that end
+                with one peg, and that end at all
+            winning_ends: distinct single-peg positions reachable
+            reachable, winning, dead_ends: per layer (one entry per peg count,
+                from the board's down), how many positions can be reached, how
+                many of those can still be solved, and how many have no moves
+                left but more than one peg
+    """
+    board = BitBoard.from_board(board)
+    shape = board.shape
+    checks = _PagodaChecks(board, None, 0, ())
+    if np is not None and shape.rows * shape.cols <= 64:
+        arrays = _LayerArrays(shape, checks)
+        layers = [np.array([shape.canonical(board.pegs)], dtype=np.uint64)]
+        while len(layers[-1]):
+            layers.append(arrays.keys(arrays.expand(layers[-1])))
+        count = lambda layer, following, wins, totals: _count_array_layer(
+            arrays, layer, following, wins, totals)
+    else:
+        layers = [{shape.canonical(board.pegs): board.pegs}]
+        while layers[-1]:
+            layers.append(_expand_layer(shape, layers[-1], checks))
+        count = lambda layer, following, wins, totals: _count_dict_layer(
+            shape, layer, following, wins, totals)
+
+    features = {"pegs": board.count, "reachable": [], "winning": [], "dead_ends": []}
+
+    # Lines from each position of the layer after the current one, in that
+    # layer's order. The empty layer after the last one has none
+    wins, totals = [], []
+    for k in range(len(layers) - 2, -1, -1):
+        pegs_left = board.count - k
+        wins, totals, stuck = count(layers[k], layers[k + 1], wins, totals)
+
+        # A position without moves is one line, and a winning one with one peg
+        for n in stuck:
+            totals[n] = 1
+            wins[n] = 1 if pegs_left == 1 else 0
+        features["reachable"].append(len(layers[k]))
+        features["winning"].append(sum(1 for w in wins if w))
+        features["dead_ends"].append(len(stuck) if pegs_left > 1 else 0)
+        if pegs_left == 1:
+            features["winning_ends"] = len(layers[k])
+
+    for name in ("reachable", "winning", "dead_ends"):
+        features[name].reverse()
+    features["winning_lines"] = int(wins[0])
+    features["total_lines"] = int(totals[0])
+    features.setdefault("winning_ends", 0)
+    return features
+
+
+def _count_array_layer(arrays: "_LayerArrays", layer, following, wins, totals):
+    """ One step of count_lines with NumPy layers of sorted canonical masks: the
+        winning and total lines of each position of layer, from those of the
+        following layer, and the indices of the positions without moves. Counts
+        are Python ints in object arrays, since they outgrow 64 bits
+    """
+    layer_wins = np.zeros(len(layer), dtype=object)
+    layer_totals = np.zeros(len(layer), dtype=object)
+    moved = np.zeros(len(layer), dtype=bool)
+    for flip, need in arrays.moves:
+        parents = np.flatnonzero((layer & flip) == need)
+        if len(parents):
+            children = np.searchsorted(
+                following, arrays._canonical(layer[parents] ^ flip)
+            )
+            layer_wins[parents] += wins[children]
+            layer_totals[parents] += totals[children]
+            moved[parents] = True
+    return layer_wins, layer_totals, np.flatnonzero(~moved).tolist()
+
+
+def _count_dict_layer(shape: BoardShape, layer: dict, following: dict, wins, totals):
+    """ _count_array_layer for layers kept as dicts without NumPy """
+    order = {key: n for n, key in enumerate(following)}
+    layer_wins, layer_totals, stuck = [], [], []
+    for n, pegs in enumerate(layer.values()):
+        images = shape.images(pegs)
+        children = [
+            order[min(map(operator.xor, images, shape.move_images[move]))]
+            for move in BitBoard(shape, pegs).total_moves()
+        ]
+        layer_wins.append(sum(wins[child] for child in children))
+        layer_totals.append(sum(totals[child] for child in children))
+        if not children:
+            stuck.append(n)
+    return layer_wins, layer_totals, stuck
+
 ########################################################################################
 
 # Check this website for the logic on how this works:
 # http://www.cut-the-knot.org/proofs/PegsAndGroups.Bialostocki
 def bialostocki_solver(board: PegSolitaire) -> bool:
-    x_y_z = board.copy()
-    x = True
-    y = False
-    z = False
-    x_count = y_count = z_count = 0
-    # Fill the board with x, y, and z
-    for i, row in enumerate(x_y_z.board):
-        for j, spot in enumerate(row):
-            if x == True:
-                if(spot == PEG):
-                    x_count += 1
-                x = False
-                y = True
-            elif y == True:
-                if(spot == PEG):
-                    y_count += 1
-                y = False
-                z = True
-            elif z == True:
-                if(spot == PEG):
-                    z_count += 1
-                z = False
-                x = True
-
-    x_count %= 2
-    y_count %= 2
-    z_count %= 2
-
-    if (x == 0 and y == 0 and z == 0) or (x == 1 and y == 1 and z == 1):
-        return False
-    return True
+    """ A quick test that rules out boards that can't be solved: returns False if
+        the board's position class (BoardShape.position_class) differs from that
+        of every single-peg position, and True if it might be solvable
+    """
+    if not isinstance(board, BitBoard):
+        board = BitBoard.from_board(board)
+    return board.shape.position_class(board.pegs) in board.shape.final_classes
+
+
+def bialostocki_filter(boards: list) -> List[bool]:
+    """ bialostocki_solver over a whole list of boards (frozensets, PegSolitaires or
+        BitBoards). Boards are grouped by shape, whose colour masks they share.
+        With NumPy, the position classes of a group are worked out all at once
+        from an array of its peg masks; without it, or for shapes of more than
+        64 cells, one board at a time
+    """
+    masks = [board_masks(board) for board in boards]
+    groups = {}
+    for i, (rows, cols, walls, _) in enumerate(masks):
+        groups.setdefault((rows, cols, walls), []).append(i)
+
+    feasible = [False] * len(boards)
+    for (rows, cols, walls), indices in groups.items():
+        shape = get_shape(rows, cols, walls)
+        if np is not None and rows * cols <= 64:
+            pegs = np.array([masks[i][3] for i in indices], dtype=np.uint64)
+            signature = np.zeros(len(indices), dtype=np.uint64)
+            for colours in shape.diagonals:
+                p0, p1, p2 = [_parities(pegs & np.uint64(mask)) for mask in colours]
+                signature = ((signature << np.uint64(2))
+                             | ((p0 ^ p1) << np.uint64(1)) | (p1 ^ p2))
+            classes = np.array(sorted(shape.final_classes), dtype=np.uint64)
+            found = np.isin(signature, classes).tolist()
+        else:
+            found = [
+                shape.position_class(masks[i][3]) in shape.final_classes
+                for i in indices
+            ]
+        for i, solvable in zip(indices, found):
+            feasible[i] = solvable
+    return feasible
+
+
+def _parities(values):
+    """ The parity of the number of set bits of each uint64 of an array """
+    for shift in (32, 16, 8, 4, 2, 1):
+        values = values ^ (values >> np.uint64(shift))
+    return values & np.uint64(1)
 
 ########################################################################################
 
-def main():
-    fzs = process_frozen_sets(sys.argv[1])
-    boards = []
-    for i, fz in enumerate(fzs):
-        boards.append(PegSolitaire(fz))
-
-    solvable = []
-    output = open(sys.argv[1][:-4] + "_solvable.txt", "w")
-    for i, board in enumerate(boards):
-        if len(solvable) == 20:
-            break
-        print("Board {}".format(i))
-
-        # Attempt to solve the board, keeping track of how long it takes
-        start = time.time()
-        if a_star_solve(board) == True:
-            end = time.time()
-            # Remember how long it takes to solve from the top left
-            board.forward_solve_time = end - start;
-            print("Board {} is solvable from top left".format(i))
-
-            # Now reverse the board so that you can solve from the bottom right
-            temp = board.copy()
-            temp.board = temp.reverse_board
-
-            # Try to solve the same board from the bottom right, keeping track of how
-            # long it takes
-            start = time.time()
-            if a_star_solve(temp) == True:
-                end = time.time()
-
-                # Remember how long it takes to solve from the bottom right
-                board.backward_solve_time = end - start
-
-                solvable.append(board)
-
-                print("Board {} is solvable from bottom right".format(i))
-
-                # Write the successful board to an output file
-                output.write("{}\n{} {}\n".format(
-                        str(fzs[i]) + "\n",
-                        board.forward_solve_time,
-                        board.backward_solve_time,
-                    )
+# The search engines main() can run, by their --engine name
+ENGINES = {
+    "astar": a_star_solve,
+    "dfs": dfs_solve,
+    "bidirectional": bidirectional_solve,
+    "layered": layered_solve,
+}
+
+
+def board_key(board: PegSolitaire) -> str:
+    """ A text key for a board that is the same for all its mirror images and
+        rotations that keep the walls in place: rows x cols, then the wall mask and
+        the canonical peg mask in hex
+    """
+    board = BitBoard.from_board(board)
+    shape = board.shape
+    return "{}x{}:{:x}:{:x}".format(
+        shape.rows, shape.cols, shape.walls, shape.canonical(board.pegs)
+    )
+
+########################################################################################
+
+# How each spot is drawn in the ASCII board format of successfull_boards_ascii.txt
+ASCII_SPOTS = {WALL: "█", HOLE: "O", PEG: "*"}
+
+
+def ascii_board(board: PegSolitaire) -> str:
+    """ The board in the ASCII format, one line per row """
+    return "\n".join("".join(ASCII_SPOTS[spot] for spot in row) for row in board.board)
+
+
+def replay(board: PegSolitaire, moves: list) -> List[PegSolitaire]:
+    """ The board followed by the board after each move, without changing board """
+    boards = [board.copy()]
+    for move in moves:
+        boards.append(boards[-1].copy())
+        boards[-1].perform_move(*move)
+    return boards
+
+
+def export_solution(board: PegSolitaire, moves: list, path: str):
+    """ Writes a board and the moves solving it to path. A .json file holds the
+        board as a CompleteBoard and the moves as [x1, y1, x2, y2] lists; any
+        other file gets the board after every move in the ASCII format, separated
+        by blank lines
+    """
+    if not isinstance(board, PegSolitaire):
+        board = BitBoard.from_board(board).to_peg_solitaire()
+    with open(path, "w") as f:
+        if path.endswith(".json"):
+            moves = [list(move) for move in moves]
+            json.dump({"board": board.board, "moves": moves}, f)
+        else:
+            steps = replay(board, moves)
+            f.write("\n\n".join(ascii_board(step) for step in steps) + "\n")
+
+
+def load_solution(path: str) -> Tuple[PegSolitaire, list]:
+    """ Reads a board and its moves back from a file written by export_solution, so
+        the solution can be replayed without solving again. For an ASCII file the
+        moves are worked out from each board and the next
+    """
+    with open(path) as f:
+        if path.endswith(".json"):
+            solution = json.load(f)
+            moves = [tuple(move) for move in solution["moves"]]
+            return PegSolitaire(None, solution["board"]), moves
+        text = f.read()
+
+    spots = {char: spot for spot, char in ASCII_SPOTS.items()}
+    grids = [
+        [[spots[char] for char in line] for line in block.splitlines()]
+        for block in text.strip("\n").split("\n\n")
+    ]
+    moves = [_move_between(before, after) for before, after in zip(grids, grids[1:])]
+    return PegSolitaire(None, grids[0]), moves
+
+
+def _move_between(before: CompleteBoard, after: CompleteBoard) -> tuple:
+    """ The jump that turns one board into the other """
+    landed, emptied = None, []
+    for x, row in enumerate(before):
+        for y, spot in enumerate(row):
+            if spot == HOLE and after[x][y] == PEG:
+                landed = (x, y)
+            elif spot == PEG and after[x][y] == HOLE:
+                emptied.append((x, y))
+    if landed is None or len(emptied) != 2:
+        raise ValueError("consecutive boards don't differ by one jump")
+
+    # The peg came from whichever emptied spot is two cells from where it landed
+    x2, y2 = landed
+    for x1, y1 in emptied:
+        if abs(x1 - x2) + abs(y1 - y2) == 2:
+            return (x1, y1, x2, y2)
+    raise ValueError("consecutive boards don't differ by one jump")
+
+########################################################################################
+
+class SolveCache:
+    """ Solve results kept on disk between runs, so a rerun over a file only has to
+        solve the boards it hasn't seen before. Results are keyed by board_key and
+        engine name and hold the outcome ("solvable", "unsolvable" or "timeout"),
+        the solve time, the time limit it ran under, and optionally the solution
+        path and search stats as JSON.
+
+        The cache holds at most max_entries results. When it grows past that, the
+        least recently used ones are dropped.
+    """
+
+    def __init__(self, path: str, max_entries: int = SOLVE_CACHE_SIZE):
+        self.max_entries = max_entries
+        # Several worker processes may share one cache file, so wait for each
+        # other's writes rather than failing
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT, engine TEXT, status TEXT, seconds REAL, time_limit REAL,"
+            " path TEXT, stats TEXT, used REAL, PRIMARY KEY (key, engine))"
+        )
+        self._trim()
+
+    def lookup(self, board: PegSolitaire, engine: str) -> dict:
+        """ The cached result for board, or None. A timeout only counts if it ran
+            under a time limit at least as long as the current BOARD_SOLVE_TIME
+        """
+        key = board_key(board)
+        row = self.connection.execute(
+            "SELECT status, seconds, time_limit, path, stats FROM results"
+            " WHERE key = ? AND engine = ?", (key, engine)
+        ).fetchone()
+        if row is None:
+            return None
+
+        status, seconds, time_limit, path, stats = row
+        if status == "timeout" and time_limit < BOARD_SOLVE_TIME:
+            return None
+
+        self.connection.execute(
+            "UPDATE results SET used = ? WHERE key = ? AND engine = ?",
+            (time.time(), key, engine),
+        )
+        self.connection.commit()
+        return {
+            "status": status,
+            "seconds": seconds,
+            "time_limit": time_limit,
+            "path": json.loads(path) if path else None,
+            "stats": json.loads(stats) if stats else None,
+        }
+
+    def store(self, board: PegSolitaire, engine: str, status: str, seconds: float,
+              path: list = None, stats: dict = None):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                board_key(board), engine, status, seconds, BOARD_SOLVE_TIME,
+                json.dumps(path) if path is not None else None,
+                json.dumps(stats) if stats is not None else None,
+                time.time(),
+            ),
+        )
+
+        self._trim()
+
+    def _trim(self):
+        """ Forgets the least recently used results once the cache is over its size """
+        count = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM results WHERE rowid IN"
+                " (SELECT rowid FROM results ORDER BY used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+########################################################################################
+
+# A solvability database file starts with this header: a magic string, then the
+# rows, columns and wall mask of its shape. The bitset follows at SOLVABILITY_OFFSET
+SOLVABILITY_MAGIC = b"PEGSOLV1"
+SOLVABILITY_HEADER = struct.Struct("<8sIIQ")
+SOLVABILITY_OFFSET = 64
+
+# The databases loaded with load_solvability_db, by shape. _solve answers from
+# these before searching
+_DATABASES = {}
+
+
+class SolvabilityDB:
+    """ A file with one bit per position of a board shape saying whether a single
+        peg can be reached from it, built by build_solvability_db. The file is
+        memory-mapped read-only, so checking a board is one lookup and processes
+        that open the same file share its pages instead of loading it each.
+
+        Positions are numbered by their pegs, taking the shape's cells in order
+        and skipping walls, so a shape with n cells has 2 ** n bits.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, rows, cols, walls = SOLVABILITY_HEADER.unpack_from(self.map)
+        if magic != SOLVABILITY_MAGIC:
+            raise ValueError("{} is not a solvability database".format(path))
+        self.shape = get_shape(rows, cols, walls)
+        self.tables = _cell_index_tables(self.shape)
+
+    def solvable(self, board: PegSolitaire) -> bool:
+        """ Whether board can be solved. It has to have this database's shape """
+        board = BitBoard.from_board(board)
+        if board.shape != self.shape:
+            raise ValueError("board doesn't have the shape of this database")
+        return self._marked(board.pegs)
+
+    def solution(self, board: PegSolitaire) -> list:
+        """ The moves of a solution of a solvable board, found by always making a
+            move to another solvable position
+        """
+        board = BitBoard.from_board(board)
+        moves = []
+        while board.count > 1:
+            for move in board.total_moves():
+                if self._marked(board.pegs ^ self.shape.move_images[move][0]):
+                    break
+            moves.append(move)
+            board.perform_move(*move)
+        return moves
+
+    def _marked(self, pegs: int) -> bool:
+        index = _position_number(self.shape, self.tables, pegs)
+        return bool(self.map[SOLVABILITY_OFFSET + (index >> 3)] >> (index & 7) & 1)
+
+    def close(self):
+        self.map.close()
+
+
+def _cell_index_tables(shape: BoardShape) -> List[List[int]]:
+    """ Chunk tables (BoardShape.chunk_tables) from a peg mask to its position
+        number in a SolvabilityDB
+    """
+    ranks = []
+    for cell in range(shape.rows * shape.cols):
+        if shape.cells >> cell & 1:
+            ranks.append(1 << popcount(shape.cells & ((1 << cell) - 1)))
+        else:
+            ranks.append(0)
+    return shape.chunk_tables(ranks, operator.or_)
+
+
+def _position_number(shape: BoardShape, tables: List[List[int]], pegs: int) -> int:
+    """ The position number of a peg mask, given the _cell_index_tables of its shape """
+    bits = shape.chunk_bits
+    mask = (1 << bits) - 1
+    t0, t1, t2, t3 = tables
+    return (t0[pegs & mask] | t1[(pegs >> bits) & mask]
+            | t2[(pegs >> 2 * bits) & mask] | t3[pegs >> 3 * bits])
+
+
+def load_solvability_db(path: str) -> SolvabilityDB:
+    """ Opens a solvability database and has every engine answer boards of its
+        shape from it instead of searching
+    """
+    database = SolvabilityDB(path)
+    _DATABASES[database.shape] = database
+    return database
+
+
+def build_solvability_db(board: PegSolitaire, path: str):
+    """ Writes the solvability database of board's wall layout to path. It works
+        backward from every single-peg position, undoing one jump at a time
+        across the whole layer of positions with one more peg, and marks each
+        position it reaches; those are exactly the ones that can be solved. The
+        marks themselves tell new positions from ones already seen, so only the
+        current and next layer are held in memory.
+
+        Needs NumPy and a shape of at most 64 cells. The file takes 2 ** n / 8
+        bytes for n cells (1 GiB for the 33 cells of the usual 7x7 boards).
+    """
+    if np is None:
+        raise ImportError("building a solvability database needs NumPy")
+    shape = BitBoard.from_board(board).shape
+    if shape.rows * shape.cols > 64:
+        raise ValueError("solvability databases only cover boards of up to 64 cells")
+
+    cells = [cell for cell in range(shape.rows * shape.cols) if shape.cells >> cell & 1]
+    size = SOLVABILITY_OFFSET + max(1, (1 << len(cells)) // 8)
+    building = path + ".tmp"
+    marks = np.memmap(building, dtype=np.uint8, mode="w+", shape=(size,))
+    marks[:SOLVABILITY_HEADER.size] = np.frombuffer(SOLVABILITY_HEADER.pack(
+        SOLVABILITY_MAGIC, shape.rows, shape.cols, shape.walls
+    ), dtype=np.uint8)
+    bitset = marks[SOLVABILITY_OFFSET:]
+
+    # The search runs on position numbers rather than peg masks: numbering only
+    # drops the walls, so undoing a jump still flips the numbers of its three cells
+    tables = _cell_index_tables(shape)
+
+    # Undoing a jump needs a peg on its landing cell and holes on the other two
+    moves = []
+    for source, over, dest in shape.moves:
+        flip = _position_number(shape, tables, shape.move_images[source + dest][0])
+        landing = _position_number(shape, tables, shape.bit(*dest))
+        moves.append((np.uint64(flip), np.uint64(landing)))
+
+    def mark_new(positions):
+        """ Marks the positions (sorted, without repeats) not marked yet and
+            returns them
+        """
+        byte = (positions >> np.uint64(3)).astype(np.intp)
+        bit = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+        new = (bitset[byte] & bit) == 0
+        positions, byte, bit = positions[new], byte[new], bit[new]
+        if len(positions):
+            # Positions sharing a byte are next to each other, so OR their bits
+            # together and write each byte once
+            starts = np.flatnonzero(np.concatenate(([True], byte[1:] != byte[:-1])))
+            bitset[byte[starts]] |= np.bitwise_or.reduceat(bit, starts)
+        return positions
+
+    # Layers can outgrow memory in the middle, so they are kept in files of
+    # LAYER_FILE_SIZE positions and mapped back in to be expanded
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.TemporaryDirectory(dir=directory) as spill:
+        singles = np.array([1 << n for n in range(len(cells))], dtype=np.uint64)
+        layer = _spill([mark_new(singles)], spill, 1)
+        pegs_left = 1
+        while layer and pegs_left < len(cells):
+            pegs_left += 1
+            following, waiting = [], []
+            for name in layer:
+                part = np.load(name, mmap_mode="r")
+                for first in range(0, len(part), LAYER_CHUNK_SIZE):
+                    positions = np.asarray(part[first:first + LAYER_CHUNK_SIZE])
+                    before = mark_new(_sorted_unique(np.concatenate([
+                        positions[(positions & flip) == need] ^ flip
+                        for flip, need in moves
+                    ])))
+                    waiting.append(before)
+                    if sum(map(len, waiting)) >= LAYER_FILE_SIZE:
+                        following += _spill(waiting, spill, pegs_left, len(following))
+                        waiting = []
+                del part
+                os.remove(name)
+            layer = following + _spill(waiting, spill, pegs_left, len(following))
+            print("{} pegs: {} solvable positions".format(
+                pegs_left, sum(len(np.load(name, mmap_mode="r")) for name in layer)
+            ))
+
+    marks.flush()
+    del marks
+    os.replace(building, path)
+
+
+def _spill(parts: list, directory: str, pegs_left: int, n: int = 0) -> List[str]:
+    """ Saves a batch of a build_solvability_db layer to a file, returning the file
+        names (none if the batch is empty)
+    """
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        return []
+    name = os.path.join(directory, "{}-{}.npy".format(pegs_left, n))
+    np.save(name, np.concatenate(parts))
+    return [name]
+
+########################################################################################
+
+def board_masks(board) -> Tuple[int, int, int, int]:
+    """ The rows, cols, wall mask and peg mask of a BitBoard, PegSolitaire,
+        CompleteBoard or frozenset, read off without building a BoardShape
+    """
+    if isinstance(board, BitBoard):
+        return board.shape.rows, board.shape.cols, board.shape.walls, board.pegs
+    if isinstance(board, frozenset):
+        return _frozen_set_masks(board)
+    if isinstance(board, PegSolitaire):
+        board = board.board
+
+    rows, cols = len(board), len(board[0])
+    walls = pegs = 0
+    for x, row in enumerate(board):
+        for y, spot in enumerate(row):
+            if spot == WALL:
+                walls |= 1 << (x * cols + y)
+            elif spot == PEG:
+                pegs |= 1 << (x * cols + y)
+    return rows, cols, walls, pegs
+
+
+def _frozen_set_masks(instructions: BoardSet) -> Tuple[int, int, int, int]:
+    """ board_masks of a frozenset: like PegSolitaire, every cell is a wall unless
+        it has a peg or is linked to the board
+    """
+    pegs, cells = [], []
+    for name, value in instructions:
+        if name == "peg":
+            pegs.append(value)
+        elif name == "linked":
+            cells.append(value)
+        elif name == "size":
+            cols, rows = value
+    peg_mask = cell_mask = 0
+    for x, y in pegs:
+        peg_mask |= 1 << ((x - 1) * cols + y - 1)
+    for x, y in cells:
+        cell_mask |= 1 << ((x - 1) * cols + y - 1)
+    walls = ((1 << (rows * cols)) - 1) & ~(cell_mask | peg_mask)
+    return rows, cols, walls, peg_mask
+
+########################################################################################
+
+def timed_solve(board: PegSolitaire, engine: str, cache: SolveCache = None,
+                results: dict = None, path: list = None, budget: Budget = None,
+                stats: SearchStats = None) -> Tuple[bool, float]:
+    """ Solves board with one of the ENGINES, returning whether it can be solved and
+        how many seconds that took. With a cache, a board solved in an earlier run
+        is answered from it, along with the time that solve took. If path is
+        given, a solution is appended to it, and budget limits the solve and
+        stats counts it, as in a_star_solve.
+    """
+    bits = BitBoard.from_board(board)
+    key = _results_key(bits)
+
+    # The cache keeps solutions turned to match the canonical mask, since one
+    # entry answers every mirror image and rotation of the board
+    if cache is not None:
+        entry = cache.lookup(board, engine)
+        if entry is not None and entry["status"] == "solvable" and path is not None:
+            if entry["path"] is not None:
+                path.extend(
+                    _turn_moves(bits.shape.turn(key[1], bits.pegs), entry["path"])
                 )
+                return True, entry["seconds"]
+        elif entry is not None:
+            return entry["status"] == "solvable", entry["seconds"]
+
+    # The engines only put finished searches in results, so a board missing from
+    # it afterwards ran out of time. A board that was already in it wasn't
+    # searched (unless its solution was wanted), so its time isn't worth caching
+    if results is None:
+        results = {}
+    searched = key not in results or (path is not None and results[key])
+
+    budget = Budget() if budget is None else budget
+    start = time.time()
+    solved = ENGINES[engine](
+        board, results=results, path=path, budget=budget, stats=stats
+    )
+    seconds = time.time() - start
+
+    # Only running out of time is worth remembering of the ways a budget can end
+    # a search, since the cache knows which time limit it ran under
+    if cache is not None and searched and budget.stopped in (None, "time"):
+        if key not in results:
+            status = "timeout"
+        else:
+            status = "solvable" if solved else "unsolvable"
+        moves = None
+        if solved and path is not None:
+            moves = _turn_moves(bits.shape.turn(bits.pegs, key[1]), path)
+        info = budget.stats
+        if stats is not None:
+            info.update(stats.as_dict())
+        cache.store(board, engine, status, seconds, moves, info)
+    return solved, seconds
+
+
+def solve_both_ways(board: PegSolitaire, engine: str, cache: SolveCache = None,
+                    path: list = None, budget: Budget = None, stats: list = None):
+    """ Solves board from the top left and, if that works, turned around
+        (reverse_board) from the bottom right. Returns the two solve times, with
+        None for a direction that failed or wasn't tried. If path is given, the
+        solution from the top left is appended to it. budget limits each of the
+        two solves on its own. If stats is given, the SearchStats.as_dict() of
+        each solve is appended to it, with its "direction" and budget stats
+    """
+    # The two directions don't share a results table: when turning the board
+    # around is one of its symmetries the reverse solve would be answered from
+    # the forward one, leaving no time of its own to report
+    def solve(board, direction, path=None, cache=cache):
+        counted = SearchStats() if stats is not None else None
+        solved, seconds = timed_solve(board, engine, cache, None, path, budget, counted)
+        if stats is not None:
+            budget_stats = budget.stats if budget is not None else None
+            stats.append(
+                dict(direction=direction, **counted.as_dict(), budget=budget_stats)
+            )
+        return solved, seconds
+
+    solved, forward_time = solve(board, "forward", path)
+    if not solved:
+        return None, None
+
+    # Now reverse the board so that you can solve from the bottom right
+    temp = board.copy()
+    temp.board = temp.reverse_board
+
+    # For the same reason the reverse solve skips the cache when it shares the
+    # forward board's key, or it would be answered with the forward time
+    reverse_cache = cache if board_key(temp) != board_key(board) else None
+    solved, backward_time = solve(temp, "backward", cache=reverse_cache)
+    if not solved:
+        return forward_time, None
+    return forward_time, backward_time
+
+########################################################################################
+
+# The SolveCache and Budget of a batch_solve worker process
+_worker_cache = None
+_worker_budget = None
+
+
+def _worker_init(time_limit: float, cache_path: str, cache_size: int, databases: list,
+                 budget: Budget, pagoda_limit: int, detectors: tuple):
+    """ Sets up a batch_solve worker with the parent's time limit, budget,
+        PAGODA_LIMIT and DEAD_DETECTORS, its own connection to the parent's cache
+        file, and the parent's solvability databases (mapped again, so the
+        workers share the pages)
+    """
+    global BOARD_SOLVE_TIME, PAGODA_LIMIT, DEAD_DETECTORS
+    global _worker_cache, _worker_budget
+    BOARD_SOLVE_TIME = time_limit
+    PAGODA_LIMIT = pagoda_limit
+    DEAD_DETECTORS = detectors
+    _worker_budget = budget
+    if cache_path:
+        _worker_cache = SolveCache(cache_path, cache_size)
+    for path in databases:
+        load_solvability_db(path)
+
+
+def _solve_task(task, cache: SolveCache = None, budget: Budget = None):
+    i, board, engine, paths, counted, profile = task
+    path = [] if paths else None
+    stats = [] if counted else None
+    profiler = cProfile.Profile() if profile else None
+    if profiler is not None:
+        profiler.enable()
+    forward_time, backward_time = solve_both_ways(
+        board, engine,
+        cache if cache is not None else _worker_cache, path,
+        budget if budget is not None else _worker_budget, stats,
+    )
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile)
+    return i, forward_time, backward_time, path, stats
+
+
+def batch_solve(boards: Iterable, engine: str, cache_path: str = None,
+                cache_size: int = SOLVE_CACHE_SIZE, jobs: int = 1, paths: bool = False,
+                budget: Budget = None, stats: bool = False, profiles: list = None):
+    """ Runs solve_both_ways on every board and yields (index, forward time,
+        backward time, solution, stats) in the order of boards. The solution is
+        the list of moves from the top left when paths is True and the board
+        could be solved that way, and None otherwise. stats is the list of
+        search stats of each direction tried when stats is True, and None
+        otherwise.
+
+        With jobs > 1 the boards are spread over that many worker processes, each
+        enforcing BOARD_SOLVE_TIME on its own boards, and results are still
+        yielded in input order as soon as they are ready. Closing the generator
+        early (e.g. once enough solvable boards are found) stops the workers and
+        drops every board not solved yet.
+
+        budget limits every solve. If it holds a CancelToken, cancelling it stops
+        the search in progress and ends the batch; give workers a shared one.
+
+        boards can be any iterable, and is only read as the boards are needed.
+        profiles is a list of a file path per board, which may be filled in as
+        boards is read: each board's solves are profiled with cProfile and the
+        stats dumped there, for merge_profiles to sum up.
+    """
+    cancelled = lambda: (
+        budget is not None and budget.token is not None and budget.token.cancelled
+    )
+    tasks = (
+        (i, board, engine, paths, stats, profiles[i] if profiles is not None else None)
+        for i, board in enumerate(boards)
+    )
+
+    if jobs <= 1:
+        cache = SolveCache(cache_path, cache_size) if cache_path else None
+        try:
+            for task in tasks:
+                if cancelled():
+                    break
+                yield _solve_task(task, cache, budget)
+        finally:
+            if cache is not None:
+                cache.close()
+        return
+
+    databases = [database.path for database in _DATABASES.values()]
+    initargs = (
+        BOARD_SOLVE_TIME, cache_path, cache_size, databases, budget, PAGODA_LIMIT,
+        DEAD_DETECTORS,
+    )
+    pool = multiprocessing.Pool(jobs, _worker_init, initargs)
+    try:
+        for result in pool.imap(_solve_task, tasks):
+            if cancelled():
+                break
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
 
+########################################################################################
 
-            # f = open("success/successfull_boards_ascii_{}.txt".format(i), "w")
-            # print("Board {} is solvable!".format(i))
-            # for j, row in enumerate(board.board):
-            #     for k, spot in enumerate(row):
-            #         f.write(spot)
-            #         if k != len(row) - 1:
-            #             f.write(" ")
-            #     if j != len(row) - 1:
-            #         f.write("\n")
-            # solvable.append(i)
+def merge_profiles(paths: list, summary: str, top: int = PROFILE_TOP):
+    """ Writes a summary of the cProfile files at paths (those that exist) to the
+        file summary: the total seconds profiled for each file, then the top
+        functions of all of them together, ranked by the time spent in each
+        function itself and then by the time spent under it
+    """
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        return
+    with open(summary, "w") as f:
+        for path in paths:
+            f.write("{}: {:.3f}s\n".format(path, pstats.Stats(path).total_tt))
+        f.write("\n")
+        merged = pstats.Stats(*paths, stream=f)
+        merged.sort_stats("tottime").print_stats(top)
+        merged.sort_stats("cumulative").print_stats(top)
 
-    # print(solvable)
-    # print("Total solvable puzzles: {}".format(len(solvable)))
+########################################################################################
+
+class RunJournal:
+    """ An append-only file of the boards a batch run over input_file has finished
+        and their results, so a run that is stopped or crashes can pick up where
+        it left off. Its first line says which version of input_file (by size and
+        modification time) and which settings it was written for; a journal that
+        doesn't match them, or any journal if fresh is True, is started over.
+
+        Results are held back and written batch results at a time, each batch
+        flushed to disk before record returns. A line cut short by a crash is
+        skipped when the journal is read back, and cut off before appending
+    """
+
+    def __init__(self, path: str, input_file: str, settings: dict, fresh: bool = False,
+                 batch: int = JOURNAL_BATCH):
+        stat = os.stat(input_file)
+        header = {
+            "input": input_file, "size": stat.st_size, "mtime": stat.st_mtime_ns,
+            "settings": settings,
+        }
+        self.batch = batch
+        self.pending = []
+
+        # Results by board number, in the order they were finished
+        self.done = {}
+        data = b""
+        if not fresh and os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+        lines = data.decode(errors="replace").splitlines()
+        if lines and _json_line(lines[0]) == header:
+            for line in lines[1:]:
+                result = _json_line(line)
+                if result is not None:
+                    self.done[result["board"]] = result
+            self.file = open(path, "a")
+            # Anything after the last newline is a line a crash cut short, which
+            # the next result would otherwise be appended to
+            self.file.truncate(data.rfind(b"\n") + 1)
+        else:
+            self.file = open(path, "w")
+            self.file.write(json.dumps(header) + "\n")
+            self._sync()
+
+    def solvable(self) -> List[int]:
+        """ The boards finished so far that can be solved from both corners """
+        return [
+            board for board, result in self.done.items()
+            if result["forward"] is not None and result["backward"] is not None
+        ]
+
+    def record(self, board: int, forward_time: float, backward_time: float) -> bool:
+        """ Adds a board's result, returning whether that wrote out a batch """
+        result = {"board": board, "forward": forward_time, "backward": backward_time}
+        self.done[board] = result
+        self.pending.append(result)
+        if len(self.pending) < self.batch:
+            return False
+        self.flush()
+        return True
+
+    def flush(self):
+        for result in self.pending:
+            self.file.write(json.dumps(result) + "\n")
+        self.pending = []
+        self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def _json_line(line: str):
+    """ A journal line, or None if it was cut short """
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def write_solvable(path: str, input_file: str, journal: RunJournal):
+    """ Writes the boards of a run that can be solved from both corners to path,
+        each as its line of input_file, a blank line and its two solve times, in
+        the order they were solved. Only results already written to the journal
+        are included, and path is replaced in one step, so the file always
+        matches what a rerun would resume from
+    """
+    with open(path + ".tmp", "w") as f:
+        for board in journal.solvable():
+            result = journal.done[board]
+            if result in journal.pending:
+                continue
+            line = next(read_board_lines(input_file, board, board + 1))[0]
+            f.write("{}\n\n{} {}\n".format(line, result["forward"], result["backward"]))
+    os.replace(path + ".tmp", path)
+
+########################################################################################
+
+def main():
+    global BOARD_SOLVE_TIME, PAGODA_LIMIT, DEAD_DETECTORS
+    parser = argparse.ArgumentParser(
+        description="Find boards in a file of frozensets that can be solved from "
+        "both corners, and write them to <input>_solvable.txt"
+    )
+    parser.add_argument("input_file", help="file with one board frozenset per line")
+    parser.add_argument(
+        "--engine", choices=sorted(ENGINES), default="astar",
+        help="search engine to solve the boards with (default: astar)",
+    )
+    parser.add_argument(
+        "--cache", metavar="PATH",
+        help="keep solve results in this file and reuse them on later runs",
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=SOLVE_CACHE_SIZE,
+        help="most results to keep in the cache (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=1,
+        help="number of worker processes to solve boards in (default: 1)",
+    )
+    parser.add_argument(
+        "--time", type=float,
+        help="wall seconds to spend on each solve (default: {})".format(
+            BOARD_SOLVE_TIME
+        ),
+    )
+    parser.add_argument(
+        "--cpu-time", type=float,
+        help="CPU seconds to spend on each solve (default: no limit)",
+    )
+    parser.add_argument(
+        "--nodes", type=int,
+        help="most positions to expand in each solve (default: no limit)",
+    )
+    parser.add_argument(
+        "--max-visited", type=int,
+        help="most positions a solve may hold at once (default: no limit)",
+    )
+    parser.add_argument(
+        "--pagoda", metavar="N", type=int,
+        help="number of pagoda functions to prune each search with "
+        "(default: {}, which turns pagoda pruning off)".format(PAGODA_LIMIT),
+    )
+    parser.add_argument(
+        "--detector", choices=("isolated", "islands"), action="append",
+        help="check each new position with this dead-position detector (can be "
+        "given once per detector; default: none)",
+    )
+    parser.add_argument(
+        "--database", metavar="PATH", action="append", default=[],
+        help="look boards up in this solvability database instead of searching "
+        "them (can be given once per wall layout)",
+    )
+    parser.add_argument(
+        "--build-database", metavar="PATH",
+        help="build the solvability database of the input file's wall layout at "
+        "PATH and exit",
+    )
+    parser.add_argument(
+        "--boards", metavar="START:STOP", default=":",
+        help="only read this slice of the input file's boards, seeking to it "
+        "through the file's offset index (default: all of them)",
+    )
+    parser.add_argument(
+        "--fresh", action="store_true",
+        help="start over instead of resuming from <input>_journal.jsonl",
+    )
+    parser.add_argument(
+        "--solutions", metavar="DIR",
+        help="write the solution of each solvable board to DIR as board_<n>.json "
+        "and board_<n>.txt (ASCII boards after every jump)",
+    )
+    parser.add_argument(
+        "--count", metavar="PATH",
+        help="count the winning and total lines of every board instead of solving "
+        "them, writing one JSON line of features per board to PATH",
+    )
+    parser.add_argument(
+        "--stats", action="store_true",
+        help="write the search stats of every solve to <input>_stats.jsonl",
+    )
+    parser.add_argument(
+        "--profile", metavar="DIR",
+        help="profile each board's solves with cProfile, writing DIR/board_<n>.prof "
+        "and a summary ranked by function to DIR/summary.txt",
+    )
+    args = parser.parse_args()
+
+    if args.time is not None:
+        BOARD_SOLVE_TIME = args.time
+    if args.pagoda is not None:
+        PAGODA_LIMIT = args.pagoda
+    if args.detector is not None:
+        DEAD_DETECTORS = tuple(args.detector)
+    budget = Budget(
+        cpu_seconds=args.cpu_time, nodes=args.nodes, visited=args.max_visited
+    )
+
+    start, _, stop = args.boards.partition(":")
+    first = int(start) if start else 0
+    records = read_board_lines(args.input_file, first, int(stop) if stop else None)
+
+    if args.build_database:
+        board, layouts = None, set()
+        for _, fz in records:
+            board = board or fz
+            layouts.add(board_masks(fz)[:3])
+        if len(layouts) != 1:
+            sys.exit("The boards in {} don't share one wall layout".format(
+                args.input_file
+            ))
+        build_solvability_db(PegSolitaire(board), args.build_database)
+        return
+
+    for path in args.database:
+        load_solvability_db(path)
+
+    if args.count:
+        with open(args.count, "w") as f:
+            for i, (_, fz) in enumerate(records, first):
+                features = count_lines(PegSolitaire(fz))
+                f.write(json.dumps(dict(board=i, **features)) + "\n")
+                f.flush()
+                print("Board {}: {} of {} lines win".format(
+                    i, features["winning_lines"], features["total_lines"]
+                ))
+        return
+
+    # Boards finished by an earlier run over the same file and settings are skipped,
+    # and their results kept
+    journal = RunJournal(
+        args.input_file[:-4] + "_journal.jsonl", args.input_file,
+        {
+            "engine": args.engine, "time": BOARD_SOLVE_TIME, "cpu_time": args.cpu_time,
+            "nodes": args.nodes, "max_visited": args.max_visited,
+            "pagoda": PAGODA_LIMIT, "detectors": list(DEAD_DETECTORS),
+            "databases": args.database,
+        },
+        args.fresh,
+    )
+    if journal.done:
+        print("Resuming: {} boards already done".format(len(journal.done)))
+    solvable = journal.solvable()
+    output_path = args.input_file[:-4] + "_solvable.txt"
+    stats_output = None
+    if args.stats:
+        stats_output = open(
+            args.input_file[:-4] + "_stats.jsonl", "a" if journal.done else "w"
+        )
+    if args.solutions:
+        os.makedirs(args.solutions, exist_ok=True)
+    profiles = None
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+        profiles = []
+
+    # The boards are read, screened and handed to batch_solve as it asks for them,
+    # so only the ones being solved are held. candidates numbers them in the order
+    # batch_solve gets them, and boards keeps them until their results are in
+    candidates = []
+    boards = {}
+
+    def unsolved():
+        numbered = enumerate(records, first)
+        while True:
+            batch = list(itertools.islice(numbered, FILTER_BATCH))
+            if not batch:
+                return
+            # Skip boards that are ruled out without having to search them
+            feasible = bialostocki_filter([fz for _, (_, fz) in batch])
+            for (i, (_, fz)), possible in zip(batch, feasible):
+                if not possible:
+                    print("Board {} can't be solved (position class)".format(i))
+                elif i not in journal.done:
+                    candidates.append(i)
+                    boards[i] = PegSolitaire(fz)
+                    if profiles is not None:
+                        profiles.append(
+                            os.path.join(args.profile, "board_{}.prof".format(i))
+                        )
+                    yield boards[i]
+
+    results = batch_solve(
+        unsolved() if len(solvable) < 20 else [], args.engine,
+        args.cache, args.cache_size, args.jobs, bool(args.solutions), budget,
+        args.stats,
+        profiles,
+    )
+    try:
+        for n, forward_time, backward_time, moves, stats in results:
+            i = candidates[n]
+            board = boards.pop(i)
+            print("Board {}".format(i))
+
+            if stats_output is not None:
+                for solve in stats:
+                    line = json.dumps(dict(board=i, engine=args.engine, **solve))
+                    stats_output.write(line + "\n")
+                stats_output.flush()
+
+            # Write out the solvable boards whenever a batch of results reaches
+            # the journal
+            if journal.record(i, forward_time, backward_time):
+                write_solvable(output_path, args.input_file, journal)
+
+            # batch_solve tried the board from both corners; a time is None if that
+            # way couldn't be solved
+            if forward_time is not None:
+                # Remember how long it takes to solve from the top left
+                board.forward_solve_time = forward_time
+                print("Board {} is solvable from top left".format(i))
+
+                if backward_time is not None:
+                    # Remember how long it takes to solve from the bottom right
+                    board.backward_solve_time = backward_time
+
+                    solvable.append(i)
+
+                    print("Board {} is solvable from bottom right".format(i))
+
+                    if args.solutions:
+                        name = os.path.join(args.solutions, "board_{}".format(i))
+                        export_solution(board, moves, name + ".json")
+                        export_solution(board, moves, name + ".txt")
+
+                    # Stop (and cancel any outstanding work) once there are enough
+                    if len(solvable) == 20:
+                        break
+
+                # f = open("success/successfull_boards_ascii_{}.txt".format(i), "w")
+                # print("Board {} is solvable!".format(i))
+                # for j, row in enumerate(board.board):
+                #     for k, spot in enumerate(row):
+                #         f.write(spot)
+                #         if k != len(row) - 1:
+                #             f.write(" ")
+                #     if j != len(row) - 1:
+                #         f.write("\n")
+                # solvable.append(i)
+
+        # print(solvable)
+        # print("Total solvable puzzles: {}".format(len(solvable)))
+    finally:
+        # Even when stopped early, keep every result finished so far
+        results.close()
+        journal.close()
+        write_solvable(output_path, args.input_file, journal)
+        if stats_output is not None:
+            stats_output.close()
+    if profiles:
+        merge_profiles(profiles, os.path.join(args.profile, "summary.txt"))
 
 
 if __name__ == "__main__":
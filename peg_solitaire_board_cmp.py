@@ -248,8 +248,9 @@ def main(frozensets=None):
     colors = [RED, BLUE]
     color_labels = ["RED", "BLUE"]
 
+    # Only the first board of each difficulty is shown, so read just those
     if frozensets == None:
-        fzs = bs.process_frozen_sets(sys.argv[1])
+        fzs = [fz for _, fz in bs.read_board_lines(sys.argv[1], 0, len(diff))]
     else:
         fzs = frozensets
 
@@ -251,7 +251,7 @@ def main(frozensets=None):
             # Go through each string and convert it to a frozenset
             for line in lines:
                 if len(line) > 50:
-                    fzs.append(eval(line))
+                    fzs.append(bs.parse_frozen_set(line))
                 elif len(line) > 10:
                     soln_time = [float(x) for x in line.strip().split()]
                     print(max(soln_time), end="\n")
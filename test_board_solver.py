@@ -0,0 +1,191 @@
+import os
+import random
+import tempfile
+import unittest
+from functools import lru_cache
+
+import board_solver as bs
+
+
+def brute_force(grid) -> bool:
+    """ Whether a board can be solved, by trying every line of play. Written
+        straight from the rules, sharing nothing with the solver but the spot
+        values
+    """
+    rows, cols = len(grid), len(grid[0])
+    cells = [(x, y) for x in range(rows) for y in range(cols) if grid[x][y] != bs.WALL]
+    index = {cell: i for i, cell in enumerate(cells)}
+    jumps = []
+    for (x, y), i in index.items():
+        for dx, dy in ((0, 1), (1, 0), (0, -1), (-1, 0)):
+            over, dest = (x + dx, y + dy), (x + 2 * dx, y + 2 * dy)
+            if over in index and dest in index:
+                jumps.append((i, index[over], index[dest]))
+    start = frozenset(index[cell] for cell in cells if grid[cell[0]][cell[1]] == bs.PEG)
+
+    @lru_cache(maxsize=None)
+    def solvable(pegs):
+        if len(pegs) == 1:
+            return True
+        return any(
+            solvable(pegs - {source, over} | {dest})
+            for source, over, dest in jumps
+            if source in pegs and over in pegs and dest not in pegs
+        )
+
+    return solvable(start)
+
+
+def random_board(rnd: random.Random, rows: int, cols: int, walls: list) -> list:
+    """ A board of at most a dozen pegs on a grid with the given wall cells. Half
+        of them are played backwards from a single peg, so they can be solved
+    """
+    grid = [[bs.HOLE] * cols for _ in range(rows)]
+    for x, y in walls:
+        grid[x][y] = bs.WALL
+    cells = [(x, y) for x in range(rows) for y in range(cols) if grid[x][y] != bs.WALL]
+    if rnd.random() < 0.5:
+        x, y = rnd.choice(cells)
+        grid[x][y] = bs.PEG
+        for _ in range(rnd.randint(2, 10)):
+            # A backward jump: a peg hops over a hole into a hole, filling both
+            unjumps = []
+            for x, y in cells:
+                for dx, dy in ((0, 1), (1, 0), (0, -1), (-1, 0)):
+                    over, source = (x + dx, y + dy), (x + 2 * dx, y + 2 * dy)
+                    if grid[x][y] != bs.PEG or over not in cells or source not in cells:
+                        continue
+                    if grid[over[0]][over[1]] == grid[source[0]][source[1]] == bs.HOLE:
+                        unjumps.append(((x, y), over, source))
+            if not unjumps:
+                break
+            for (x, y), spot in zip(rnd.choice(unjumps), (bs.HOLE, bs.PEG, bs.PEG)):
+                grid[x][y] = spot
+    else:
+        for x, y in rnd.sample(cells, rnd.randint(2, min(12, len(cells)))):
+            grid[x][y] = bs.PEG
+    return grid
+
+
+def shapes():
+    """ (rows, cols, wall cells) for symmetric and asymmetric layouts, 4x4 to 6x6 """
+    rnd = random.Random(1)
+    yield 4, 4, []
+    yield 5, 5, [(0, 0), (0, 4), (4, 0), (4, 4)]
+    yield 6, 6, [
+        (0, 0), (0, 1), (1, 0), (0, 5), (5, 0), (5, 5), (4, 5), (5, 4), (0, 4), (1, 5),
+    ]
+    yield 4, 6, []
+    for rows, cols in ((4, 4), (5, 5), (6, 6), (5, 6)):
+        cells = [(x, y) for x in range(rows) for y in range(cols)]
+        yield rows, cols, rnd.sample(cells, rows * cols // 6)
+
+
+class EngineTest(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(2019)
+        self.boards = []
+        for rows, cols, walls in shapes():
+            for _ in range(6):
+                grid = random_board(rnd, rows, cols, walls)
+                self.boards.append((grid, brute_force(grid)))
+
+    def check_engines(self, **pruning):
+        for grid, expected in self.boards:
+            for name, engine in bs.ENGINES.items():
+                board = bs.PegSolitaire(None, [row[:] for row in grid])
+                path = []
+                with self.subTest(engine=name, board=grid):
+                    solved = engine(board, path=path, **pruning)
+                    self.assertEqual(bool(solved), expected)
+                    if expected:
+                        final = bs.replay(board, path)[-1]
+                        self.assertEqual(final.pegs_remaining(), 1)
+                        self.assertEqual(board.board, grid)
+
+    def test_engines_match_brute_force(self):
+        self.check_engines()
+
+    def test_engines_match_brute_force_without_numpy(self):
+        np, bs.np = bs.np, None
+        try:
+            self.check_engines()
+        finally:
+            bs.np = np
+
+    def test_engines_match_brute_force_with_pruning(self):
+        self.check_engines(pagoda_limit=4, detectors=("isolated", "islands"))
+
+    def test_pagoda_limit_is_read_when_searching(self):
+        limit, bs.PAGODA_LIMIT = bs.PAGODA_LIMIT, 4
+        try:
+            # pagoda_checks picks no functions for the first board
+            grid, _ = self.boards[1]
+            stats = bs.SearchStats()
+            bs.a_star_solve(bs.PegSolitaire(None, grid), stats=stats)
+            self.assertEqual(len(stats.cuts), 4)
+        finally:
+            bs.PAGODA_LIMIT = limit
+
+    def test_dead_detectors_are_read_when_searching(self):
+        detectors, bs.DEAD_DETECTORS = bs.DEAD_DETECTORS, ("isolated", "islands")
+        try:
+            grid, _ = self.boards[1]
+            stats = bs.SearchStats()
+            bs.a_star_solve(bs.PegSolitaire(None, grid), stats=stats)
+            self.assertEqual(set(stats.cuts), {"isolated", "islands"})
+            self.assertGreater(stats.cuts["isolated"], 0)
+        finally:
+            bs.DEAD_DETECTORS = detectors
+
+    def test_stopped_search_reports_its_budget(self):
+        # A full board, far too big for the few nodes before the budget is checked
+        rows, cols, walls = list(shapes())[2]
+        grid = [[bs.PEG] * cols for _ in range(rows)]
+        for x, y in walls:
+            grid[x][y] = bs.WALL
+        grid[1][2] = bs.HOLE
+        for name, engine in bs.ENGINES.items():
+            with self.subTest(engine=name):
+                result = engine(bs.PegSolitaire(None, grid), budget=bs.Budget(nodes=1))
+                self.assertFalse(result)
+                self.assertEqual(result.stopped, "nodes")
+                self.assertGreaterEqual(result.stats["nodes"], 1)
+
+    def test_reverse_solve_of_symmetric_board_is_timed(self):
+        # Turning the 4x4 boards without walls around is one of their symmetries,
+        # so both directions share a cache key
+        grid = next(grid for grid, expected in self.boards[:6] if expected)
+        board = bs.PegSolitaire(None, grid)
+        reverse = board.copy()
+        reverse.board = reverse.reverse_board
+        self.assertEqual(bs.board_key(board), bs.board_key(reverse))
+        with tempfile.TemporaryDirectory() as directory:
+            cache = bs.SolveCache(os.path.join(directory, "cache.sqlite"))
+            forward, backward = bs.solve_both_ways(board, "astar", cache)
+            cache.connection.close()
+        self.assertIsNotNone(backward)
+        self.assertNotEqual(forward, backward)
+
+    def test_replayed_moves_are_jumps(self):
+        for grid, expected in self.boards:
+            if not expected:
+                continue
+            path = []
+            bs.a_star_solve(bs.PegSolitaire(None, [row[:] for row in grid]), path=path)
+            pegs = {(x, y) for x, row in enumerate(grid) for y, spot in enumerate(row)
+                    if spot == bs.PEG}
+            for x1, y1, x2, y2 in path:
+                over = ((x1 + x2) // 2, (y1 + y2) // 2)
+                self.assertEqual(abs(x1 - x2) + abs(y1 - y2), 2)
+                self.assertIn((x1, y1), pegs)
+                self.assertIn(over, pegs)
+                self.assertNotIn((x2, y2), pegs)
+                self.assertNotEqual(grid[x2][y2], bs.WALL)
+                pegs = pegs - {(x1, y1), over} | {(x2, y2)}
+            self.assertEqual(len(pegs), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()